@@ -0,0 +1,199 @@
+import os
+import argparse
+import time
+import logging
+import tempfile
+import tracemalloc
+from results import ResultRow
+
+##
+## Benchmarks for the validator hot paths. Run with `python bench.py`.
+##
+
+SYSTEMS = ['http://snomed.info/sct', 'http://loinc.org', 'http://terminology.hl7.org/CodeSystem/v3-ActCode']
+REASONS = ['Code is valid.', 'Unknown code', 'Request timed out.']
+
+
+def _fresh(value):
+    # Strings parsed from separate JSON files / responses are separate objects
+    return ''.join(list(value))
+
+
+def _synthetic_rows(n, make_row):
+    rows = []
+    for i in range(n):
+        rows.append(make_row(
+            file=_fresh(f'example-{i // 50}.json'),
+            resource_id=f'res-{i // 50}',
+            path=_fresh('Observation.code.coding[0]'),
+            code=str(100000 + i),
+            display_provided=None,
+            text_context=None,
+            system=_fresh(SYSTEMS[i % len(SYSTEMS)]),
+            result=_fresh('PASS'),
+            reason=_fresh(REASONS[i % len(REASONS)]),
+            status_code=200
+        ))
+    return rows
+
+
+def measure_result_memory(n=200000):
+    """
+    Measure the bytes held by n result rows as plain dicts and as ResultRow objects.
+
+    Returns:
+        tuple: (dict_bytes, compact_bytes)
+    """
+    sizes = []
+    for make_row in (dict, ResultRow):
+        tracemalloc.start()
+        rows = _synthetic_rows(n, make_row)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sizes.append(current)
+        del rows
+    return sizes[0], sizes[1]
+
+
+def _synthetic_patient(n_names):
+    coding = {'system': 'http://example.org/cs', 'code': '1', 'display': 'One'}
+    return {
+        'resourceType': 'Patient', 'id': 'bench',
+        'text': {'status': 'generated', 'div': '<div>' + 'x' * 1000 + '</div>'},
+        'meta': {'profile': ['http://example.org/p'], 'tag': [coding]},
+        'name': [{'family': f'Family{i}', 'given': ['A', 'B'], 'period': {'start': '2020'}} for i in range(n_names)],
+        'address': [{'line': ['1 Street'], 'city': 'City', 'period': {'start': '2020'}} for _ in range(n_names)],
+        'telecom': [{'system': 'phone', 'value': '0400000000'} for _ in range(n_names)],
+        'maritalStatus': {'coding': [coding]},
+        'communication': [{'language': {'coding': [coding]}, 'preferred': True}],
+    }
+
+
+def _patient_schema():
+    from elements import ResourceSchema
+
+    schema = ResourceSchema('Patient')
+    for path, type_code in [('Patient.text', 'Narrative'), ('Patient.meta', 'Meta'), ('Patient.name', 'HumanName'),
+                            ('Patient.address', 'Address'), ('Patient.telecom', 'ContactPoint'),
+                            ('Patient.maritalStatus', 'CodeableConcept'), ('Patient.communication', 'BackboneElement'),
+                            ('Patient.communication.language', 'CodeableConcept')]:
+        schema.add_element({'path': path, 'type': [{'code': type_code}]})
+    return {'Patient': schema}
+
+
+def measure_extraction(n_resources=2000, n_names=20):
+    """
+    Time the full walk against schema-guided extraction over synthetic Patients.
+    Every code system is excluded so no server calls are made.
+
+    Returns:
+        tuple: (full_seconds, guided_seconds)
+    """
+    from rules import compile_rules
+    from tester import _extract_and_validate_elements, _extract_resource
+
+    rules = compile_rules([{'uri-regex': '.*', 'result': 'IGNORED'}])
+    schema = _patient_schema()
+    resource = _synthetic_patient(n_names)
+    timings = []
+    for guided in (False, True):
+        start = time.perf_counter()
+        for _ in range(n_resources):
+            results = []
+            if guided:
+                _extract_resource(resource, schema, 'bench.json', '', rules, 'bench', 'Patient', results)
+            else:
+                _extract_and_validate_elements(resource, 'bench.json', '', rules, 'bench', 'Patient', results)
+        timings.append(time.perf_counter() - start)
+    return timings[0], timings[1]
+
+
+def _log_codings(log, n, lazy):
+    system, path = SYSTEMS[0], 'Observation.code.coding[0]'
+    start = time.perf_counter()
+    if lazy:
+        for i in range(n):
+            log.debug("Validation result for %s|%s at %s: %s - %s", system, i, path, 'PASS', 'Code is valid.')
+    else:
+        for i in range(n):
+            log.debug(f"Validation result for {system}|{i} at {path}: {'PASS'} - {'Code is valid.'}")
+    return time.perf_counter() - start
+
+
+def _log_codings_threaded(log, n, threads):
+    import threading
+
+    workers = [threading.Thread(target=_log_codings, args=(log, n // threads, True)) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def measure_logging(n=100000, threads=8):
+    """
+    Time one per-coding debug log call, as made by validate_example_code: with debug
+    off (f-string vs lazy %-style), and with debug on through a synchronous file
+    handler vs the queue handler from logsetup, from one thread and from `threads`.
+
+    Returns:
+        dict: case -> seconds per call
+    """
+    from logging.handlers import QueueListener
+    from logsetup import LOG_FORMAT, DeferredQueueHandler
+    import queue
+
+    log = logging.getLogger('bench.logging')
+    log.propagate = False
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_handler = logging.FileHandler(os.path.join(tmpdir, 'bench.log'))
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+        log.setLevel(logging.INFO)
+        timings['debug off, f-string'] = _log_codings(log, n, lazy=False) / n
+        timings['debug off, lazy'] = _log_codings(log, n, lazy=True) / n
+
+        log.setLevel(logging.DEBUG)
+        log.addHandler(file_handler)
+        timings['file handler'] = _log_codings(log, n, lazy=True) / n
+        timings[f'file handler, {threads} threads'] = _log_codings_threaded(log, n, threads) / n
+        log.removeHandler(file_handler)
+
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, file_handler)
+        listener.start()
+        queue_handler = DeferredQueueHandler(log_queue)
+        log.addHandler(queue_handler)
+        timings['queue handler'] = _log_codings(log, n, lazy=True) / n
+        timings[f'queue handler, {threads} threads'] = _log_codings_threaded(log, n, threads) / n
+        log.removeHandler(queue_handler)
+        listener.stop()
+        file_handler.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rows", type=int, default=200000, help="Number of synthetic result rows")
+    args = parser.parse_args()
+
+    dict_bytes, compact_bytes = measure_result_memory(args.rows)
+    print(f"result rows: {args.rows}")
+    print(f"  dict rows:      {dict_bytes / 1e6:8.1f} MB")
+    print(f"  ResultRow rows: {compact_bytes / 1e6:8.1f} MB ({100 * (1 - compact_bytes / dict_bytes):.0f}% saved)")
+
+    full, guided = measure_extraction()
+    print("extraction: 2000 Patients")
+    print(f"  full walk:      {full * 1000:8.1f} ms")
+    print(f"  schema-guided:  {guided * 1000:8.1f} ms ({full / guided:.1f}x faster)")
+
+    print("logging overhead per coding:")
+    for case, seconds in measure_logging().items():
+        print(f"  {case + ':':30s} {seconds * 1e9:8.0f} ns")
+
+
+if __name__ == '__main__':
+    main()
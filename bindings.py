@@ -0,0 +1,262 @@
+import os
+import re
+import json
+import glob
+import logging
+from results import ResultRow
+from rules import normalise_path
+from txresponse import parse_validate_code_response, is_rejection
+from txpool import tx_get, LRUCache, Counters
+
+logger = logging.getLogger(__name__)
+
+##
+## ValueSet binding validation
+##
+## Bindings are read from the StructureDefinitions in the npm packages fetched by
+## getter.get_npm_packages. Each bound ValueSet is expanded once via $expand (paged)
+## into a set of (system, code) pairs and every coding is checked locally. ValueSets
+## that are too large or that the server will not expand fall back to one cached
+## ValueSet/$validate-code call per distinct (valueset, system, code). ValueSets
+## enumerated in the packages are answered from the terminology index (txindex.py).
+## Server calls go through txpool.tx_get, so they are balanced and failed over like
+## the code validation calls, and each answer records the server that gave it.
+## Only definite answers are cached, in bounded LRUs: timeouts, 429s and 5xx responses
+## are asked again on the next use, so watch mode and the service recover from them.
+##
+
+CHECKED_STRENGTHS = ('required', 'extensible')
+CHOICE_TYPE_SUFFIXES = ('CodeableConcept', 'Coding', 'Quantity')
+EXPAND_PAGE_SIZE = 1000
+MAX_EXPANSION_SIZE = 20000
+MAX_CACHED_EXPANSIONS = 1000       # ValueSets kept expanded (or known not expandable)
+MAX_CACHED_VALIDATIONS = 100000    # ValueSet/$validate-code answers kept
+_CODING_RE = re.compile(r'\.coding\[\d+\]$')
+
+
+class Binding:
+    __slots__ = ['path', 'strength', 'valueset', 'profile']
+
+    def __init__(self, path, strength, valueset, profile):
+        self.path = path
+        self.strength = strength
+        self.valueset = valueset
+        self.profile = profile
+
+
+def _element_bindings(sd):
+    elements = (sd.get('snapshot') or sd.get('differential') or {}).get('element', [])
+    for element in elements:
+        binding = element.get('binding') or {}
+        element_id = element.get('id') or element.get('path') or ''
+        # Slice bindings only apply to slice members, which we can't tell apart here
+        if ':' in element_id or binding.get('strength') not in CHECKED_STRENGTHS or not binding.get('valueSet'):
+            continue
+        path = element.get('path') or element_id
+        if path.endswith('[x]'):
+            path = path[:-3]
+        yield path, binding['strength'], binding['valueSet']
+
+
+def load_bindings(package_paths):
+    """
+    Read required/extensible bindings from every StructureDefinition in the packages.
+
+    Args:
+        package_paths (list): npm package folders, as returned by get_npm_packages.
+
+    Returns:
+        dict: profile url -> {element path (no indexes) -> [Binding]}
+    """
+    index = {}
+    for package_path in package_paths:
+        for sd_file in glob.glob(os.path.join(package_path, '*.json')):
+            try:
+                with open(sd_file) as f:
+                    sd = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning("Could not read package file %s: %s", sd_file, e)
+                continue
+            if not isinstance(sd, dict) or sd.get('resourceType') != 'StructureDefinition' or not sd.get('url'):
+                continue
+            profile_bindings = index.setdefault(sd['url'], {})
+            for path, strength, valueset in _element_bindings(sd):
+                profile_bindings.setdefault(path, []).append(Binding(path, strength, valueset, sd['url']))
+    logger.info("Loaded bindings for %s StructureDefinitions from %s packages", len(index), len(package_paths))
+    return index
+
+
+def binding_paths(coding_path):
+    """
+    Candidate element paths for the CodeableConcept holding a coding, e.g.
+    'Observation.valueCodeableConcept.coding[0]' -> ['Observation.valueCodeableConcept', 'Observation.value']
+    """
+    element_path = normalise_path(_CODING_RE.sub('', coding_path))
+    paths = [element_path]
+    parent, _, last = element_path.rpartition('.')
+    for suffix in CHOICE_TYPE_SUFFIXES:
+        if last.endswith(suffix) and len(last) > len(suffix):
+            paths.append(f"{parent}.{last[:-len(suffix)]}")
+    return paths
+
+
+def _flatten_contains(contains, codes):
+    for entry in contains or []:
+        if entry.get('code') is not None and not entry.get('abstract'):
+            codes.add((entry.get('system'), entry['code']))
+        _flatten_contains(entry.get('contains'), codes)
+
+
+class ValueSetCache:
+    """
+    Cached ValueSet expansions (as hash sets) with a server $validate-code fallback.
+    """
+
+    def __init__(self, endpoint, max_size=MAX_EXPANSION_SIZE, page_size=EXPAND_PAGE_SIZE, tx_index=None,
+                 max_expansions=MAX_CACHED_EXPANSIONS, max_validations=MAX_CACHED_VALIDATIONS):
+        self.endpoint = endpoint   # server url or EndpointPool
+        self.max_size = max_size
+        self.tx_index = tx_index
+        self.page_size = page_size
+        # valueset url -> (set of (system, code) or None when too large or refused, server url)
+        self.expansions = LRUCache(max_expansions)
+        # (valueset url, system, code) -> (in_valueset, message, server url), definite answers only
+        self.validated = LRUCache(max_validations)
+        self.stats = Counters('expansions', 'expand_requests', 'index_checks', 'local_checks', 'server_checks')
+
+    def expand(self, url):
+        """
+        Expand a ValueSet once, following paging. A ValueSet that is too large, or that the
+        server refuses to expand (4xx), is remembered as not expandable; after a transient
+        failure the expansion is tried again on the next call.
+
+        Returns:
+            tuple: (set of (system, code) pairs, or None if the ValueSet is too large or
+                   could not be expanded; url of the server that expanded it)
+        """
+        cached = self.expansions.get(url)
+        if cached is not None:
+            return cached
+        codes = set()
+        offset = 0
+        server = None
+        try:
+            while True:
+                params = {'url': url, 'count': self.page_size, 'offset': offset}
+                response, server = tx_get(self.endpoint, 'ValueSet/$expand', params, timeout=60)
+                self.stats.add('expand_requests')
+                response.raise_for_status()
+                expansion = response.json().get('expansion', {})
+                total = expansion.get('total')
+                if total is not None and total > self.max_size:
+                    logger.info("ValueSet %s has %s codes, checking membership on the server instead", url, total)
+                    codes = None
+                    break
+                page = expansion.get('contains') or []
+                _flatten_contains(page, codes)
+                offset += len(page)
+                if not page or (total is not None and offset >= total) or (total is None and len(page) < self.page_size):
+                    break
+                if len(codes) > self.max_size:
+                    codes = None
+                    break
+        except Exception as e:
+            logger.warning("Could not expand ValueSet %s, checking membership on the server instead: %s", url, e)
+            if not is_rejection(e):
+                return None, server   # not cached, the next call tries again
+            codes = None
+        if codes is not None:
+            self.stats.add('expansions')
+        self.expansions[url] = (codes, server)
+        return codes, server
+
+    def _validate_on_server(self, url, system, code):
+        key = (url, system, code)
+        cached = self.validated.get(key)
+        if cached is not None:
+            return cached
+        self.stats.add('server_checks')
+        server = None
+        try:
+            params = {'url': url, 'system': system, 'code': code}
+            response, server = tx_get(self.endpoint, 'ValueSet/$validate-code', params, system, timeout=15)
+            response.raise_for_status()
+            is_valid, _, message = parse_validate_code_response(response.json())
+        except Exception as e:
+            return None, f"ValueSet $validate-code failed: {e}", server
+        answer = (is_valid, message, server)
+        if response.status_code == 200 and is_valid is not None:
+            self.validated[key] = answer
+        return answer
+
+    def contains(self, url, system, code):
+        """
+        Returns:
+            tuple: (in_valueset, message, server url) where in_valueset is True, False or None
+                   if unknown, and server url is None when the terminology index answered.
+        """
+        if self.tx_index is not None:
+            # Enumerated ValueSets from the IG packages don't need the server at all
+            in_vs = self.tx_index.valueset_contains(url, system, code)
+            if in_vs is not None:
+                self.stats.add('index_checks')
+                return in_vs, None, None
+        codes, server = self.expand(url)
+        if codes is not None:
+            self.stats.add('local_checks')
+            return (system, code) in codes, None, server
+        return self._validate_on_server(url, system, code)
+
+
+def check_bindings(resource, file_results, binding_index, vs_cache, rules=None):
+    """
+    Check the codings found in a resource against the bindings of the profiles it claims.
+
+    Args:
+        resource (dict): The FHIR resource the results came from.
+        file_results (list): ResultRows from _extract_and_validate_elements.
+        binding_index (dict): As returned by load_bindings.
+        vs_cache (ValueSetCache): Shared expansion cache.
+        rules (ExclusionRules): Codings matched by an exclusion rule are not binding checked.
+
+    Returns:
+        list: One ResultRow per (coding, binding) checked.
+    """
+    profiles = [p.split('|')[0] for p in (resource.get('meta') or {}).get('profile', [])]
+    profile_bindings = [binding_index[p] for p in profiles if p in binding_index]
+    if not profile_bindings:
+        return []
+
+    binding_results = []
+    for row in file_results:
+        if not row.system or not row.code or not row.path or not _CODING_RE.search(row.path):
+            continue
+        if rules is not None and rules.match(row.system, row.code, row.path, count=False) is not None:
+            continue
+        for path in binding_paths(row.path):
+            # The same ValueSet is often bound by several profiles the resource claims
+            bindings = list({(b.valueset, b.strength): b for pb in profile_bindings for b in pb.get(path, ())}.values())
+            for binding in bindings:
+                in_vs, message, server = vs_cache.contains(binding.valueset, row.system, row.code)
+                if in_vs is True:
+                    result, reason = 'PASS', f"Code is in {binding.strength} ValueSet {binding.valueset}."
+                elif in_vs is False:
+                    result = 'FAIL' if binding.strength == 'required' else 'WARNING'
+                    reason = f"Code is not in {binding.strength} ValueSet {binding.valueset} ({binding.profile})."
+                else:
+                    result, reason = 'ERROR', message or f"Could not check membership of ValueSet {binding.valueset}."
+                binding_results.append(ResultRow(
+                    file=row.file,
+                    resource_id=row.resource_id,
+                    path=f"{row.path} (binding)",
+                    code=row.code,
+                    display_provided=row.display_provided,
+                    text_context=row.text_context,
+                    system=row.system,
+                    result=result,
+                    reason=reason,
+                    server=server
+                ))
+            if bindings:
+                break
+    return binding_results
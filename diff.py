@@ -0,0 +1,209 @@
+import os
+import csv
+import sys
+import shutil
+import hashlib
+import argparse
+import tempfile
+import logging
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+##
+## Run-to-run diff
+##
+## Every run writes its result rows to TestDataValidationResults-{ts}.csv, with two extra
+## columns that make each row's key unique: `source`, the instance path relative to the
+## json folder (the report's `file` is only the file name), and `occurrence`, numbering
+## rows of one source that share resource_id, path, system and code (e.g. the two ERROR
+## rows of a coding with a display but no code, or several binding rows on one path).
+## diff_runs hash-joins a previous results file with the current one on
+## (source, resource_id, path, system, code, occurrence) and writes only what changed:
+##   NEW_FAIL        failing now, not failing (or absent) before
+##   FIXED           failing before, not failing now
+##   CHANGED_REASON  failing in both runs, with a different result or reason
+##   REMOVED         failing before, no longer reported at all
+## Only the previous run's failures are loaded into the hash table; the current run is
+## streamed past it. Very large runs are first partitioned by key hash into temporary
+## files (a grace hash join), so one partition's failures are in memory at a time.
+##
+
+KEY_FIELDS = ['source', 'resource_id', 'path', 'system', 'code', 'occurrence']
+DIFF_HEADER = ['change'] + KEY_FIELDS + ['previous_result', 'result', 'previous_reason', 'reason']
+FAILING = frozenset(['FAIL', 'ERROR'])
+PARTITION_BYTES = 512 * 1024 * 1024   # previous-run csv bytes joined per partition
+
+NEW_FAIL = 'NEW_FAIL'
+FIXED = 'FIXED'
+CHANGED_REASON = 'CHANGED_REASON'
+REMOVED = 'REMOVED'
+
+
+def write_results_csv(file_results, csv_file):
+    """
+    Write result rows to the machine readable results file read by diff_runs.
+
+    Args:
+        file_results (iterable): (source, ResultRows) per instance file, where source is
+                                 the file's path relative to the json folder.
+        csv_file (str): The results csv to write.
+    """
+    from results import RESULT_HEADER
+
+    tmp_file = csv_file + '.tmp'
+    with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_HEADER + ['source', 'occurrence'])
+        for source, rows in file_results:
+            seen = {}   # (resource_id, path, system, code) -> rows so far in this source
+            for row in rows:
+                key = (row.resource_id, row.path, row.system, row.code)
+                occurrence = seen.get(key, 0)
+                seen[key] = occurrence + 1
+                writer.writerow([getattr(row, field) for field in RESULT_HEADER] + [source, occurrence])
+    os.replace(tmp_file, csv_file)
+
+
+def _read_slim(csv_file):
+    """
+    Yield (key tuple, result, reason) for every row of a results csv.
+    """
+    with open(csv_file, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        try:
+            key_idx = [header.index(field) for field in KEY_FIELDS]
+            result_idx = header.index('result')
+            reason_idx = header.index('reason')
+        except ValueError as e:
+            raise ValueError(f"{csv_file} is not a results file: {e}")
+        key_of = itemgetter(*key_idx)
+        for record in reader:
+            yield key_of(record), record[result_idx], record[reason_idx]
+
+
+def _partition_of(key, partitions):
+    digest = hashlib.blake2b('\x1f'.join(key).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % partitions
+
+
+def _partition(csv_file, partitions, tmpdir, prefix, failing_only=False):
+    """
+    Split a results csv into `partitions` slim csv files by key hash.
+    """
+    files = [open(os.path.join(tmpdir, f'{prefix}-{i}.csv'), 'w', newline='', encoding='utf-8') for i in range(partitions)]
+    try:
+        writers = [csv.writer(f) for f in files]
+        for key, result, reason in _read_slim(csv_file):
+            if failing_only and result not in FAILING:
+                continue
+            writers[_partition_of(key, partitions)].writerow(key + (result, reason))
+    finally:
+        for f in files:
+            f.close()
+    return [f.name for f in files]
+
+
+def _read_partition(part_file):
+    n = len(KEY_FIELDS)
+    with open(part_file, newline='', encoding='utf-8') as f:
+        for record in csv.reader(f):
+            yield tuple(record[:n]), record[n], record[n + 1]
+
+
+def _join(previous_rows, current_rows):
+    """
+    Hash-join one partition: build on the previous run's failures, probe with the current run.
+    Yields diff records.
+    """
+    previous = {key: (result, reason) for key, result, reason in previous_rows if result in FAILING}
+    for key, result, reason in current_rows:
+        before = previous.pop(key, None) if previous else None
+        if before is None:
+            if result in FAILING:
+                yield (NEW_FAIL,) + key + ('', result, '', reason)
+            continue
+        previous_result, previous_reason = before
+        if result not in FAILING:
+            yield (FIXED,) + key + (previous_result, result, previous_reason, reason)
+        elif previous_result != result or previous_reason != reason:
+            yield (CHANGED_REASON,) + key + (previous_result, result, previous_reason, reason)
+    for key, (previous_result, previous_reason) in previous.items():
+        yield (REMOVED,) + key + (previous_result, '', previous_reason, '')
+
+
+def diff_runs(previous_csv, current_csv, diff_csv, partition_bytes=PARTITION_BYTES):
+    """
+    Write the changes between two runs' results files to diff_csv.
+
+    Args:
+        previous_csv (str): Results csv of the earlier run.
+        current_csv (str): Results csv of the later run.
+        diff_csv (str): Output csv, one row per change (see DIFF_HEADER).
+        partition_bytes (int): Size of previous-run input joined in memory at once.
+
+    Returns:
+        dict: Count of each change type.
+    """
+    counts = {NEW_FAIL: 0, FIXED: 0, CHANGED_REASON: 0, REMOVED: 0}
+    partitions = max(1, -(-os.path.getsize(previous_csv) // partition_bytes))
+    tmp_file = diff_csv + '.tmp'
+    with open(tmp_file, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(DIFF_HEADER)
+
+        def emit(records):
+            for record in records:
+                counts[record[0]] += 1
+                writer.writerow(record)
+
+        if partitions == 1:
+            emit(_join(_read_slim(previous_csv), _read_slim(current_csv)))
+        else:
+            tmpdir = tempfile.mkdtemp(prefix='tx-diff-')
+            try:
+                previous_parts = _partition(previous_csv, partitions, tmpdir, 'previous', failing_only=True)
+                current_parts = _partition(current_csv, partitions, tmpdir, 'current')
+                for previous_part, current_part in zip(previous_parts, current_parts):
+                    emit(_join(_read_partition(previous_part), _read_partition(current_part)))
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+    os.replace(tmp_file, diff_csv)
+    logger.info("Diff of %s and %s in %s partition(s): %s", previous_csv, current_csv, partitions, counts)
+    return counts
+
+
+def diff_exit_status(counts):
+    """
+    1 if the current run introduced failures, else 0.
+    """
+    return 1 if counts[NEW_FAIL] else 0
+
+
+def print_diff_summary(counts, diff_csv):
+    print(f"{counts[NEW_FAIL]} new failures, {counts[FIXED]} fixed, "
+          f"{counts[CHANGED_REASON]} changed reasons, {counts[REMOVED]} failures no longer reported")
+    print(f"Changes written to {diff_csv}")
+
+
+def main():
+    """
+    python diff.py PREVIOUS.csv CURRENT.csv [-o DIFF.csv]
+    Exits 1 if CURRENT has failures that PREVIOUS did not.
+    """
+    parser = argparse.ArgumentParser(description="Compare two TestDataValidationResults csv files")
+    parser.add_argument("previous", help="Results csv of the earlier run")
+    parser.add_argument("current", help="Results csv of the later run")
+    parser.add_argument("-o", "--output", help="Diff csv to write", default="TestDataValidationDiff.csv")
+    args = parser.parse_args()
+
+    counts = diff_runs(args.previous, args.current, args.output)
+    print_diff_summary(counts, args.output)
+    sys.exit(diff_exit_status(counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import re
+import logging
+import unicodedata
+from urllib.parse import urlencode
+from results import ResultRow
+from txpool import tx_get, tx_post, LRUCache, Counters
+from txresponse import is_rejection
+
+logger = logging.getLogger(__name__)
+
+##
+## Display text validation
+##
+## The designations (display plus every designation in any language or use) of each
+## distinct (system, code) are fetched once with CodeSystem/$lookup, sent as FHIR
+## batch Bundles, and cached. Provided displays are compared locally after
+## normalisation, so any valid designation (e.g. an AU English one) is accepted.
+## Lookups go through txpool (balanced, failed over, and routed by code system, one
+## system per batch), and each display row records the server that answered. Only
+## successful lookups are cached, in a bounded LRU; a failed lookup is an ERROR row
+## for that check and is asked again on the code's next use.
+##
+
+LOOKUP_BATCH_SIZE = 50
+MAX_CACHED_CODES = 100000   # codes whose designations are kept
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalise_display(text):
+    """
+    Normalise display text for comparison: unicode NFKC, case folded, whitespace collapsed.
+    """
+    if text is None:
+        return ''
+    return _SPACE_RE.sub(' ', unicodedata.normalize('NFKC', text).casefold()).strip()
+
+
+def parse_lookup_response(response_json):
+    """
+    Parses the Parameters returned by CodeSystem/$lookup.
+
+    Returns:
+        set: The normalised display and designation values, or None if not a Parameters resource.
+    """
+    if not isinstance(response_json, dict) or response_json.get('resourceType') != 'Parameters':
+        return None
+    designations = set()
+    for param in response_json.get('parameter', []):
+        if not isinstance(param, dict):
+            continue
+        if param.get('name') == 'display' and param.get('valueString'):
+            designations.add(normalise_display(param['valueString']))
+        elif param.get('name') == 'designation':
+            for part in param.get('part', []):
+                if part.get('name') == 'value' and part.get('valueString'):
+                    designations.add(normalise_display(part['valueString']))
+    return designations
+
+
+class DesignationCache:
+    """
+    Designations per (system, code), fetched with batched $lookup calls.
+    """
+
+    def __init__(self, endpoint, batch_size=LOOKUP_BATCH_SIZE, max_codes=MAX_CACHED_CODES):
+        self.endpoint = endpoint   # server url or EndpointPool
+        self.batch_size = batch_size
+        self.designations = LRUCache(max_codes)   # (system, code) -> (set of normalised designations, server url)
+        self.batch_supported = True
+        self.stats = Counters('codes', 'batch_requests', 'lookup_requests')
+
+    @staticmethod
+    def _lookup_params(system, code):
+        return {'system': system, 'code': code, 'property': 'designation'}
+
+    def _lookup_one(self, system, code):
+        self.stats.add('lookup_requests')
+        server = None
+        try:
+            response, server = tx_get(self.endpoint, 'CodeSystem/$lookup', self._lookup_params(system, code), system, timeout=15)
+            response.raise_for_status()
+            designations = parse_lookup_response(response.json())
+        except Exception as e:
+            logger.warning("$lookup failed for %s|%s: %s", system, code, e)
+            return None, server
+        if response.status_code == 200 and designations is not None:
+            self.designations[(system, code)] = (designations, server)
+        return designations, server
+
+    def _lookup_batch(self, keys):
+        """
+        Look keys up in one batch Bundle, caching the entries that succeeded.
+
+        Returns:
+            dict: (system, code) -> (designations or None, server url), or None if the
+                  server answered with something other than one entry per request.
+        """
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [{'request': {'method': 'GET', 'url': 'CodeSystem/$lookup?' + urlencode(self._lookup_params(system, code))}}
+                      for system, code in keys]
+        }
+        self.stats.add('batch_requests')
+        response, server = tx_post(self.endpoint, '', bundle, keys[0][0], timeout=60)
+        response.raise_for_status()
+        entries = response.json().get('entry', [])
+        if len(entries) != len(keys):
+            logger.warning("Batch $lookup returned %s entries for %s requests", len(entries), len(keys))
+            return None
+        found = {}
+        for key, entry in zip(keys, entries):
+            status = (entry.get('response') or {}).get('status', '')
+            designations = parse_lookup_response(entry.get('resource')) if status.startswith('200') else None
+            if designations is not None:
+                self.designations[key] = (designations, server)
+            found[key] = (designations, server)
+        return found
+
+    def prefetch(self, keys):
+        """
+        Fetch designations for every (system, code) not already cached, in batches of one
+        code system each, so routed systems go to their server. Falls back to one $lookup
+        per code if the server refuses batch Bundles (a 4xx); after a transient failure
+        (timeout, 429, 5xx) batching is kept and the chunk's codes are asked again next time.
+
+        Returns:
+            dict: (system, code) -> (set of normalised designations or None if the lookup
+                  failed, server url) for every key, whether or not it stays cached.
+        """
+        found = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            hit = self.designations.get(key)
+            if hit is None:
+                missing.append(key)
+            else:
+                found[key] = hit
+        self.stats.add('codes', len(missing))
+        by_system = {}
+        for key in missing:
+            by_system.setdefault(key[0], []).append(key)
+        for system_keys in by_system.values():
+            for start in range(0, len(system_keys), self.batch_size):
+                chunk = system_keys[start:start + self.batch_size]
+                if self.batch_supported:
+                    try:
+                        batch = self._lookup_batch(chunk)
+                    except Exception as e:
+                        if not is_rejection(e):
+                            logger.warning("Batch $lookup failed, these codes are asked again on their next use: %s", e)
+                            found.update(dict.fromkeys(chunk, (None, None)))
+                            continue
+                        batch = None
+                        logger.warning("Batch $lookup refused: %s", e)
+                    if batch is not None:
+                        found.update(batch)
+                        continue
+                    logger.warning("Batch $lookup not available, looking codes up one at a time")
+                    self.batch_supported = False
+                for system, code in chunk:
+                    found[(system, code)] = self._lookup_one(system, code)
+        return found
+
+    def get(self, system, code):
+        """
+        Returns:
+            tuple: (set of normalised designations or None if the lookup failed, server url)
+        """
+        return self.prefetch([(system, code)])[(system, code)]
+
+
+def check_displays(file_results, designation_cache):
+    """
+    Check provided display text against the designations of each valid code.
+
+    Args:
+        file_results (list): ResultRows from _extract_and_validate_elements.
+        designation_cache (DesignationCache): Shared designation cache.
+
+    Returns:
+        list: One ResultRow per coding with a display, on codes that passed validation.
+    """
+    rows = [row for row in file_results
+            if row.result == 'PASS' and row.display_provided and row.system and row.code]
+    found = designation_cache.prefetch([(row.system, row.code) for row in rows])
+
+    display_results = []
+    for row in rows:
+        designations, server = found[(row.system, row.code)]
+        if designations is None:
+            result, reason = 'ERROR', 'Could not look up designations for this code.'
+        elif normalise_display(row.display_provided) in designations:
+            result, reason = 'PASS', 'Display matches a designation of the code.'
+        else:
+            result = 'FAIL'
+            reason = f"Display ('{row.display_provided}') does not match any of the {len(designations)} designations of the code."
+        display_results.append(ResultRow(
+            file=row.file,
+            resource_id=row.resource_id,
+            path=f"{row.path} (display)",
+            code=row.code,
+            display_provided=row.display_provided,
+            text_context=row.text_context,
+            system=row.system,
+            result=result,
+            reason=reason,
+            server=server
+        ))
+    return display_results
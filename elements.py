@@ -0,0 +1,118 @@
+import os
+import json
+import glob
+import logging
+
+logger = logging.getLogger(__name__)
+
+##
+## Element schema for schema-guided extraction
+##
+## For each resource type, the snapshot elements of every StructureDefinition in the
+## npm packages are merged into a map of element path -> walk kind:
+##   BACKBONE : BackboneElement/Element, descend guided by the schema
+##   RESOURCE : an inline resource (contained, Bundle.entry.resource), restart with its type
+##   WALK     : CodeableConcept, or a datatype that can hold one (Identifier.type,
+##              Reference.identifier.type, Dosage.route...), walk the whole subtree
+##   LEAF     : primitives and datatypes that can't hold a CodeableConcept, only
+##              their extensions are walked
+## Elements not in the schema are walked in full, so extraction finds every coding the
+## generic walk would. Only CodeableConcept codings are validated, as by the generic
+## walk, so bare `code` elements and Quantity (unit codes) are LEAF.
+##
+
+BACKBONE = 'backbone'
+RESOURCE = 'resource'
+WALK = 'walk'
+LEAF = 'leaf'
+
+# Complex datatypes with no CodeableConcept anywhere beneath them (extensions aside)
+NO_CODEABLE_CONCEPT_TYPES = {
+    'Coding', 'Quantity', 'SimpleQuantity', 'Age', 'Duration', 'Count', 'Distance', 'Money', 'MoneyQuantity',
+    'Range', 'Ratio', 'Period', 'SampledData', 'HumanName', 'Address', 'ContactPoint', 'Narrative',
+    'Attachment', 'Meta', 'Expression', 'xhtml'
+}
+
+
+def _choice_name(base, type_code):
+    return base + type_code[0].upper() + type_code[1:]
+
+
+def _type_kind(type_code):
+    if type_code in ('BackboneElement', 'Element'):
+        return BACKBONE
+    if type_code in ('Resource', 'DomainResource'):
+        return RESOURCE
+    if type_code in NO_CODEABLE_CONCEPT_TYPES or type_code[:1].islower() or type_code.startswith('http://hl7.org/fhirpath/'):
+        return LEAF
+    return WALK
+
+
+# Where an element has several types, keep the kind that descends furthest
+_KIND_ORDER = {LEAF: 0, BACKBONE: 1, RESOURCE: 2, WALK: 3}
+
+
+class ResourceSchema:
+    __slots__ = ['resource_type', 'kinds', 'aliases']
+
+    def __init__(self, resource_type):
+        self.resource_type = resource_type
+        self.kinds = {}     # element path (choice types expanded) -> walk kind
+        self.aliases = {}   # contentReference element path -> path it repeats
+
+    def _set(self, path, kind):
+        current = self.kinds.get(path)
+        if current is None or _KIND_ORDER[kind] > _KIND_ORDER[current]:
+            self.kinds[path] = kind
+
+    def add_element(self, element):
+        path = element.get('path', '')
+        if '.' not in path:
+            return
+        if element.get('contentReference'):
+            self.aliases[path] = element['contentReference'].split('#')[-1]
+            return
+        types = [t.get('code') for t in element.get('type', []) if t.get('code')]
+        if path.endswith('[x]'):
+            base = path[:-3]
+            for type_code in types:
+                self._set(_choice_name(base, type_code), _type_kind(type_code))
+            return
+        for type_code in types:
+            self._set(path, _type_kind(type_code))
+
+    def kind(self, path):
+        return self.kinds.get(path)
+
+
+def load_element_schema(package_paths):
+    """
+    Build the per-resourceType element schema from the StructureDefinitions in the packages.
+
+    Args:
+        package_paths (list): npm package folders, as returned by get_npm_packages.
+
+    Returns:
+        dict: resourceType -> ResourceSchema
+    """
+    schemas = {}
+    for package_path in package_paths:
+        for sd_file in glob.glob(os.path.join(package_path, '*.json')):
+            try:
+                with open(sd_file) as f:
+                    sd = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning("Could not read package file %s: %s", sd_file, e)
+                continue
+            if not isinstance(sd, dict) or sd.get('resourceType') != 'StructureDefinition' or sd.get('kind') != 'resource':
+                continue
+            resource_type = sd.get('type')
+            snapshot = (sd.get('snapshot') or {}).get('element')
+            if not resource_type or not snapshot:
+                continue
+            schema = schemas.setdefault(resource_type, ResourceSchema(resource_type))
+            for element in snapshot:
+                schema.add_element(element)
+    walked = sum(kind == WALK for schema in schemas.values() for kind in schema.kinds.values())
+    logger.info("Loaded element schema for %s resource types, %s element paths that can hold a CodeableConcept", len(schemas), walked)
+    return schemas
@@ -3,29 +3,59 @@ import subprocess
 import logging
 import shutil
 import os
+import io
+import hashlib
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from utils import get_config
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
-def get_npm_packages(mode,data_dir,config_file):
-    logger.info(f'...getting npm package files from simplifier using mode {mode}')
+DEFAULT_REGISTRY = "https://packages.simplifier.net"
+DOWNLOAD_WORKERS = 4
+
+
+def get_npm_packages(mode,data_dir,config_file,registry=DEFAULT_REGISTRY,cache_dir=None,use_npm=False):
+    """
+    Fetch the packages listed under "packages" in the config into <data_dir>/npm/node_modules.
+
+    Args:
+        mode (str): "clean" removes the node_modules folder first, anything else reuses it.
+        data_dir (str): Folder holding the npm folder.
+        config_file (str): Path to config.json.
+        registry (str): Package registry URL, or a local folder of <name>-<version>.tgz files.
+        cache_dir (str): Content-addressed tarball cache, defaults to <data_dir>/package-cache.
+        use_npm (bool): Shell out to `npm install` instead of the native fetcher.
+
+    Returns:
+        list: The package folder paths, in config order.
+    """
+    logger.info("...getting npm package files from %s using mode %s", registry, mode)
     # Load package configuration from JSON file
-    packages = get_config(config_file,key="packages")    
-    
+    packages = get_config(config_file,key="packages")
+
     # Check if npm module directory exists, create it if not
     npm_path = os.path.join(data_dir,"npm")
 
     if mode == "clean" and os.path.exists(npm_path):
         try:
             shutil.rmtree(npm_path)
-            logging.info(f'...attempting to remove node modules: {npm_path}')
+            logging.info("...attempting to remove node modules: %s", npm_path)
         except Exception as e:
-            logging.error(f'Could not remove directory and files in {npm_path}: {e}')
-    
+            logging.error("Could not remove directory and files in %s: %s", npm_path, e)
+
     if not os.path.exists(npm_path):
         os.makedirs(npm_path)
 
+    module_path = os.path.join(npm_path,'node_modules')
+    if not os.path.exists(module_path):
+        os.makedirs(module_path)
+
+    if not use_npm:
+        cache = PackageCache(cache_dir or os.path.join(data_dir,"package-cache"), registry)
+        return cache.install_all(packages, module_path)
+
     # Create a list of package folder paths to be returned
     path_list = []
     # Iterate over FHIR standards in config file
@@ -36,25 +66,151 @@ def get_npm_packages(mode,data_dir,config_file):
         title = standard['title']
 
         canonical = f'{name}@{version}'
-        module_path = os.path.join(npm_path,'node_modules')
-        if not os.path.exists(module_path):
-            os.makedirs(module_path)
         package_path = os.path.join(module_path,name)
         # canonical path should only exist if in dirty mode
         if not os.path.exists(package_path):
             # Construct npm command with registry and package info
-            npm_cmd = f"npm --registry https://packages.simplifier.net install {canonical} --prefix {npm_path}"
+            npm_cmd = f"npm --registry {registry} install {canonical} --prefix {npm_path}"
 
             # Run npm command using subprocess module
             print(f"Downloading {title}: {name} ({version})...")
             try:
                 subprocess.run(npm_cmd, shell=True, check=True)
-                logger.info(f"{name} ({version}) downloaded successfully!")
+                logger.info("%s (%s) downloaded successfully!", name, version)
             except subprocess.CalledProcessError as e:
-                logger.error(f"Error downloading {name}: {e}")
+                logger.error("Error downloading %s: %s", name, e)
         else:
-            logger.info(f'...skipping existing npm package for {title}: {name} ({version})...')
+            logger.info("...skipping existing npm package for %s: %s (%s)...", title, name, version)
         path_list.append(package_path)
-    
+
     return path_list
-        
+
+
+def extract_package(data, package_path):
+    """
+    Extract a package tarball into package_path, dropping the leading "package/" folder
+    as npm does. Members that would land outside package_path are skipped.
+    """
+    tmp_path = f"{package_path}.partial"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    root = os.path.realpath(tmp_path)
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+        for member in tar.getmembers():
+            if not (member.isfile() or member.isdir()):
+                continue
+            name = member.name.split('/', 1)[1] if member.name.startswith('package/') else member.name
+            target = os.path.realpath(os.path.join(root, name))
+            if not target.startswith(root + os.sep):
+                logger.warning("Skipping unsafe path in package tarball: %s", member.name)
+                continue
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with tar.extractfile(member) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+    # Only replace the package folder once the whole tarball has been extracted
+    if os.path.exists(package_path):
+        shutil.rmtree(package_path)
+    os.rename(tmp_path, package_path)
+
+
+class PackageCache:
+    """
+    Content-addressed store of package tarballs. Tarballs live at sha256/<digest>.tgz and
+    index.json maps name@version to its digest, so each version is downloaded once.
+    """
+
+    def __init__(self, cache_dir, registry=DEFAULT_REGISTRY):
+        self.cache_dir = cache_dir
+        self.registry = registry
+        self.index_file = os.path.join(cache_dir, "index.json")
+        os.makedirs(os.path.join(cache_dir, "sha256"), exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, "sha256", f"{digest}.tgz")
+
+    def _save_index(self):
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.index_file)
+
+    def _local_registry_path(self):
+        if self.registry.startswith("file://"):
+            return self.registry[len("file://"):]
+        if os.path.isdir(self.registry):
+            return self.registry
+        return None
+
+    def _download(self, name, version):
+        local = self._local_registry_path()
+        if local is not None:
+            # Air-gapped stand-in: a folder of <name>-<version>.tgz or <name>/<version>.tgz files
+            for candidate in (os.path.join(local, f"{name}-{version}.tgz"), os.path.join(local, name, f"{version}.tgz")):
+                if os.path.exists(candidate):
+                    with open(candidate, "rb") as f:
+                        return f.read()
+            raise FileNotFoundError(f"{name}@{version} not found in local registry {local}")
+
+        import requests
+
+        url = f"{self.registry.rstrip('/')}/{name}/{version}"
+        response = requests.get(url, timeout=120)
+        response.raise_for_status()
+        # FHIR registries serve the tarball here, a plain npm registry serves version metadata
+        if 'json' in response.headers.get('Content-Type', ''):
+            tarball = response.json()['dist']['tarball']
+            response = requests.get(tarball, timeout=120)
+            response.raise_for_status()
+        return response.content
+
+    def fetch(self, name, version):
+        """
+        Return the tarball bytes for name@version, downloading only on a cache miss.
+        """
+        key = f"{name}@{version}"
+        digest = self.index.get(key)
+        if digest and os.path.exists(self._blob_path(digest)):
+            logger.info("...using cached package %s", key)
+            with open(self._blob_path(digest), "rb") as f:
+                return f.read()
+        print(f"Downloading {key}...")
+        data = self._download(name, version)
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self._blob_path(digest)
+        if not os.path.exists(blob):
+            with open(f"{blob}.tmp", "wb") as f:
+                f.write(data)
+            os.replace(f"{blob}.tmp", blob)
+        self.index[key] = digest
+        logger.info("%s downloaded successfully (%s bytes, sha256 %s)", key, len(data), digest[:12])
+        return data
+
+    def install(self, package, module_path):
+        name, version = package['name'], package['version']
+        package_path = os.path.join(module_path, name)
+        marker = os.path.join(package_path, ".fetched-version")
+        if os.path.exists(marker) and Path(marker).read_text() == version:
+            logger.info("...skipping existing npm package for %s: %s (%s)...", package.get('title', name), name, version)
+            return package_path
+        try:
+            extract_package(self.fetch(name, version), package_path)
+            Path(marker).write_text(version)
+        except Exception as e:
+            logger.error("Error fetching %s@%s: %s", name, version, e)
+        return package_path
+
+    def install_all(self, packages, module_path, workers=DOWNLOAD_WORKERS):
+        """
+        Fetch and extract all packages in parallel into the node_modules layout.
+        """
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            path_list = list(pool.map(lambda package: self.install(package, module_path), packages))
+        self._save_index()
+        return path_list
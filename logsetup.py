@@ -0,0 +1,115 @@
+import os
+import json
+import queue
+import atexit
+import logging
+import itertools
+from logging.handlers import QueueHandler, QueueListener
+
+##
+## Logging setup
+##
+## Log calls only put records on a queue; a QueueListener thread formats them and
+## writes the log file, so formatting, file I/O and the handler lock stay off the
+## validation threads. Log calls use %-style arguments, so records below the log level are
+## never formatted. Below WARNING, --log-sample keeps only a fraction of the records.
+##
+
+LOG_FORMAT = '%(asctime)s %(lineno)d : %(message)s'
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+
+# Argument types that can't change between the log call and the listener formatting them
+_IMMUTABLE = (str, int, float, bool, type(None))
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    A QueueHandler that leaves formatting to the listener thread. QueueHandler.prepare
+    copies and formats every record in the calling thread; that is only needed when an
+    argument could change before the listener gets to it.
+    """
+
+    def prepare(self, record):
+        args = record.args
+        if not record.exc_info and (not args or (isinstance(args, tuple) and all(isinstance(arg, _IMMUTABLE) for arg in args))):
+            return record
+        return super().prepare(record)
+
+
+class BackgroundListener(QueueListener):
+    """
+    A QueueListener that can be stopped more than once (by its owner and again at exit).
+    """
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep an evenly spread `rate` fraction of the records below `below`; keep the rest.
+    """
+
+    def __init__(self, rate=1.0, below=logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.below = below
+        self._seen = itertools.count()
+
+    def filter(self, record):
+        if record.levelno >= self.below or self.rate >= 1:
+            return True
+        n = next(self._seen)
+        return int((n + 1) * self.rate) > int(n * self.rate)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, line and message.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'line': record.lineno,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(log_file, level='INFO', json_format=False, sample_rate=1.0):
+    """
+    Send every log record through a queue to a background thread writing log_file.
+
+    Args:
+        log_file (str): Log file path, appended to; its folder is created if needed.
+        level (str): Lowest level logged, one of LOG_LEVELS.
+        json_format (bool): Write JSON lines instead of plain text.
+        sample_rate (float): Fraction of DEBUG/INFO records kept (0-1); warnings and errors are always kept.
+
+    Returns:
+        QueueListener: The running listener; it is stopped (and the queue flushed) at exit.
+    """
+    os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    if sample_rate < 1:
+        queue_handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    listener = BackgroundListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -1,9 +1,12 @@
 import argparse
+import importlib.util
 import os
 import sys
-from  getter import get_npm_packages
-from tester import run_terminology_check, run_capability_test
+from  getter import get_npm_packages, DEFAULT_REGISTRY
+from tester import run_terminology_check, run_capability_test, TerminologyChecks
 from utils import check_path, get_config
+from txpool import EndpointPool
+from logsetup import setup_logging, LOG_LEVELS
 import logging
 from datetime import datetime
 
@@ -15,6 +18,19 @@ def main():
     Keyword arguments:
     -j, --jsondir : path to json data folder where test data lives
     -o, --outdir : path for report generated as html
+    -b, --bindings : also check codes against the ValueSets bound by the instance profiles
+    -d, --display : check display text against all designations of each code
+    -p, --pkgdir : folder the npm packages are downloaded to (used with --bindings)
+    --clean : remove and re-download the npm packages
+    -w, --watch : keep running, re-validating changed files and updating the html report
+    --registry : package registry URL, or a local folder of <name>-<version>.tgz files for air-gapped runs
+    --serve : run a local HTTP validation service instead of checking jsondir (see service.py)
+    --host, --port : address the validation service listens on
+    --diff : results csv of an earlier run; report only the changes since then and exit 1 on new failures
+    --store : append the results to a Parquet result store in this folder (needs pyarrow, see store.py)
+    --log-level : lowest level written to the log file (default INFO)
+    --log-sample : fraction of DEBUG/INFO log records kept, warnings and errors are always kept
+    --log-json : write the log as JSON lines
     """
     
     homedir=os.environ['HOME']
@@ -24,7 +40,27 @@ def main():
     logger = logging.getLogger(__name__)
     parser.add_argument("-j", "--jsondir", help="JSON data folder", default=defaultpath)   
     parser.add_argument("-o", "--outdir", help="JSON data folder", default=defaultoutpath)   
+    parser.add_argument("-b", "--bindings", help="Check ValueSet bindings from the profile packages", action="store_true")
+    parser.add_argument("-d", "--display", help="Check display text against the code designations", action="store_true")
+    parser.add_argument("-p", "--pkgdir", help="npm package download folder", default=defaultoutpath)
+    parser.add_argument("--clean", help="Re-download the npm packages", action="store_true")
+    parser.add_argument("-w", "--watch", help="Re-validate files in jsondir as they change", action="store_true")
+    parser.add_argument("--registry", help="Package registry URL or local folder of package tarballs", default=DEFAULT_REGISTRY)
+    parser.add_argument("--serve", help="Run a local HTTP validation service", action="store_true")
+    parser.add_argument("--host", help="Validation service host", default="127.0.0.1")
+    parser.add_argument("--port", help="Validation service port", type=int, default=8765)
+    parser.add_argument("--diff", help="Results csv of an earlier run to report changes against")
+    parser.add_argument("--store", help="Parquet result store folder to append the results to")
+    parser.add_argument("--log-level", help="Lowest level written to the log file", choices=LOG_LEVELS, default="INFO")
+    parser.add_argument("--log-sample", help="Fraction of DEBUG/INFO log records kept (0-1)", type=float, default=1.0)
+    parser.add_argument("--log-json", help="Write the log as JSON lines", action="store_true")
     args = parser.parse_args()
+    if args.diff and not os.path.isfile(args.diff):
+        parser.error(f"--diff results file not found: {args.diff}")
+    if args.store and importlib.util.find_spec('pyarrow') is None:
+        parser.error("--store needs pyarrow: pip install pyarrow")
+    if not 0 <= args.log_sample <= 1:
+        parser.error("--log-sample must be between 0 and 1")
 
     check_path(args.jsondir)
 
@@ -38,26 +74,48 @@ def main():
     ## Setup logging
     now = datetime.now() # current date and time
     ts = now.strftime("%Y%m%d-%H%M%S")
-    FORMAT='%(asctime)s %(lineno)d : %(message)s'
-    logging.basicConfig(format=FORMAT, filename=os.path.join('logs',f'ig-tx-check-{ts}.log'),level=logging.INFO)
+    log_name = f'ig-tx-check-{ts}.jsonl' if args.log_json else f'ig-tx-check-{ts}.log'
+    setup_logging(os.path.join('logs', log_name), args.log_level, args.log_json, args.log_sample)
     logger.info('Started')
     config_file = os.path.join(os.getcwd(),'config.json')
     # Get the initial config
     # config.json 
     #  - terminology server endpoint
     #  - exceptions for errors/warnings can be safely ignored or checked manually.    
-    conf = get_config(config_file,"init")[0]
-    endpoint = conf["endpoint"] 
-    # First check that the tx server instance is up 
-    http_stat = run_capability_test(endpoint)
-    if http_stat != 200:
-        logger.fatal(f'Capability test failed with status: {http_stat}')
+    #  - "init" lists one or more terminology servers, see txpool.py
+    endpoint = EndpointPool.from_config(get_config(config_file,"init"))
+    # First check that at least one tx server instance is up 
+    healthy = endpoint.check_capabilities(run_capability_test)
+    if not healthy:
+        logger.fatal("Capability test failed for every terminology server: %s", endpoint)
         sys.exit(1)
-    logger.info("Passed Capability test, continue on with other checks")
+    logger.info("Passed Capability test on %s of %s servers, continue on with other checks", len(healthy), len(endpoint.endpoints))
+
+    # Fetch the profile packages when ValueSet bindings are to be checked
+    package_paths = None
+    if args.bindings:
+        mode = "clean" if args.clean else "dirty"
+        package_paths = get_npm_packages(mode, args.pkgdir, config_file, registry=args.registry)
+
+    if args.serve:
+        from service import serve_terminology_check
+        checks = TerminologyChecks(endpoint, config_file, package_paths, args.display)
+        serve_terminology_check(checks, args.host, args.port)
+        logger.info("Finished")
+        return
+
+    if args.watch:
+        from watch import watch_terminology_check
+        checks = TerminologyChecks(endpoint, config_file, package_paths, args.display)
+        watch_terminology_check(checks, jdir, outdir)
+        logger.info("Finished")
+        return
 
     # Run Example checks
-    run_terminology_check(endpoint, config_file, jdir, outdir)
+    exit_status = run_terminology_check(endpoint, config_file, jdir, outdir, package_paths, args.display, args.diff, args.store)
     logger.info("Finished")
+    if args.diff:
+        sys.exit(exit_status)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
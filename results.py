@@ -0,0 +1,87 @@
+import sys
+
+# Column order used for every report (html, xlsx) built from result rows
+RESULT_HEADER = ['file', 'resource_id', 'path', 'code', 'display_provided', 'text_context', 'system', 'result', 'reason', 'status_code', 'server']
+
+# Fields whose values repeat heavily across rows and are worth interning
+INTERNED_FIELDS = frozenset(['file', 'path', 'system', 'result', 'reason', 'server'])
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class ResultRow:
+    """
+    A single validation result. Uses __slots__ rather than a per-row dict, and
+    interns the file/path/system/result/reason/server strings so that repeated values
+    share one object across millions of rows.
+
+    Supports item access (row['result']) so existing callers that treated
+    results as dicts keep working.
+    """
+    __slots__ = RESULT_HEADER
+
+    def __init__(self, file=None, resource_id=None, path=None, code=None, display_provided=None,
+                 text_context=None, system=None, result='UNKNOWN', reason='', status_code=None, server=None):
+        self.file = _intern(file)
+        self.resource_id = resource_id
+        self.path = _intern(path)
+        self.code = code
+        self.display_provided = display_provided
+        self.text_context = text_context
+        self.system = _intern(system)
+        self.result = _intern(result)
+        self.reason = _intern(reason)
+        self.status_code = status_code
+        self.server = _intern(server)  # the terminology server that answered, if any
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, _intern(value) if key in INTERNED_FIELDS else value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def replace(self, **changes):
+        """
+        A copy of the row with the given fields changed.
+        """
+        values = self.to_dict()
+        values.update(changes)
+        return ResultRow(**values)
+
+    def __eq__(self, other):
+        if not isinstance(other, ResultRow):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+    def __repr__(self):
+        return f"ResultRow({self.to_dict()!r})"
+
+
+def results_to_dataframe(rows):
+    """
+    Build the report DataFrame from result rows, column by column.
+    This is the only place rows are turned into pandas objects.
+    """
+    import pandas as pd
+
+    columns = {key: [getattr(row, key) for row in rows] for key in RESULT_HEADER}
+    return pd.DataFrame(columns, columns=RESULT_HEADER)
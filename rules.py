@@ -0,0 +1,225 @@
+import re
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+##
+## Exclusion rules for the "codesystem-excluded" section of config.json
+##
+## Each rule is a dict with one or more match criteria plus a result and reason:
+##   "uri"        : exact code system URI (the original form)
+##   "uri-prefix" : code system URI starts with this string, e.g. "http://example."
+##   "uri-regex"  : regular expression searched in the code system URI
+##   "code"       : exact code
+##   "code-regex" : regular expression matched against the whole code
+##   "path"       : element path, ignoring [n] indexes, that the coding sits under,
+##                  with or without the leading resource type, e.g. "component.code"
+##                  (only CodeableConcept.coding entries are extracted, so a bare
+##                  Coding such as meta.tag never reaches the rules)
+##   "path-regex" : regular expression searched in the element path (indexes stripped)
+## All criteria given in a rule must match. When several rules match, the one
+## listed first in config.json wins, as with the original linear scan.
+##
+
+CRITERIA = ['uri', 'uri-prefix', 'uri-regex', 'code', 'code-regex', 'path', 'path-regex']
+_INDEX_RE = re.compile(r'\[\d+\]')
+_END = object()  # trie terminal key
+
+
+def normalise_path(path):
+    """
+    Strip list indexes from an element path: 'Patient.meta.tag[0]' -> 'Patient.meta.tag'
+    """
+    return _INDEX_RE.sub('', path) if path else ''
+
+
+class ExclusionRule:
+    __slots__ = ['index', 'config', 'result', 'reason', 'uri', 'uri_prefix', 'uri_regex',
+                 'code', 'code_regex', 'path', 'path_regex']
+
+    def __init__(self, index, config):
+        self.index = index
+        self.config = config
+        self.result = config.get('result', 'EXCLUDED')
+        self.reason = config.get('reason', 'Code system is excluded from validation.')
+        self.uri = config.get('uri')
+        self.uri_prefix = config.get('uri-prefix')
+        self.code = config.get('code')
+        self.path = config.get('path')
+        self.uri_regex = self._compile(config, 'uri-regex')
+        self.code_regex = self._compile(config, 'code-regex')
+        self.path_regex = self._compile(config, 'path-regex')
+        if not any(key in config for key in CRITERIA):
+            raise ValueError(f"codesystem-excluded rule {index} has none of {', '.join(CRITERIA)}")
+
+    def _compile(self, config, key):
+        pattern = config.get(key)
+        if pattern is None:
+            return None
+        try:
+            return re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"codesystem-excluded rule {self.index}: invalid {key} '{pattern}': {e}")
+
+    def describe(self):
+        return ', '.join(f"{key}={self.config[key]}" for key in CRITERIA if key in self.config)
+
+    def matches(self, system, code, path):
+        """
+        Check every criterion of the rule. `path` must already be normalised.
+        """
+        if self.uri is not None and system != self.uri:
+            return False
+        if self.uri_prefix is not None and not (system and system.startswith(self.uri_prefix)):
+            return False
+        if self.uri_regex is not None and not (system and self.uri_regex.search(system)):
+            return False
+        if self.code is not None and code != self.code:
+            return False
+        if self.code_regex is not None and not (code and self.code_regex.fullmatch(code)):
+            return False
+        if self.path is not None and not _path_under(path, self.path):
+            return False
+        if self.path_regex is not None and not self.path_regex.search(path):
+            return False
+        return True
+
+
+def _path_under(path, rule_path):
+    # 'Observation.component.code' is under 'component.code' and 'Observation.component'; 'Observation.componentX' is not
+    for candidate in (path, path.partition('.')[2]):
+        if candidate == rule_path or candidate.startswith(rule_path + '.'):
+            return True
+    return False
+
+
+def _trie_insert(trie, keys, rule):
+    node = trie
+    for key in keys:
+        node = node.setdefault(key, {})
+    node.setdefault(_END, []).append(rule)
+
+
+def _trie_walk(trie, keys, found):
+    # Collect rules stored at every prefix of `keys`
+    node = trie
+    found.extend(node.get(_END, ()))
+    for key in keys:
+        node = node.get(key)
+        if node is None:
+            return
+        found.extend(node.get(_END, ()))
+
+
+class ExclusionRules:
+    """
+    The codesystem-excluded rules compiled into lookup indexes, so each coding is
+    checked with a hash lookup (uri, code), a trie walk (uri-prefix, path) and
+    only the regex rules scanned. Counts how often each rule is hit; the counts are
+    lock protected, as the validation service matches from several threads.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.hits = Counter()
+        self._lock = threading.Lock()
+        self._by_uri = {}
+        self._by_code = {}
+        self._uri_trie = {}
+        self._path_trie = {}
+        self._scan = []
+        for rule in rules:
+            # Index each rule once, on its most selective criterion
+            if rule.uri is not None:
+                self._by_uri.setdefault(rule.uri, []).append(rule)
+            elif rule.uri_prefix is not None:
+                _trie_insert(self._uri_trie, rule.uri_prefix, rule)
+            elif rule.code is not None:
+                self._by_code.setdefault(rule.code, []).append(rule)
+            elif rule.path is not None:
+                _trie_insert(self._path_trie, rule.path.split('.'), rule)
+            else:
+                self._scan.append(rule)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, system, code=None, path=None, count=True):
+        """
+        Find the first configured rule matching the coding. Set count=False
+        for lookups that shouldn't show up in the rule hit counts.
+
+        Returns:
+            ExclusionRule or None
+        """
+        candidates = []
+        if system is not None:
+            candidates.extend(self._by_uri.get(system, ()))
+            if self._uri_trie:
+                _trie_walk(self._uri_trie, system, candidates)
+        if code is not None:
+            candidates.extend(self._by_code.get(code, ()))
+        norm_path = normalise_path(path)
+        if self._path_trie and norm_path:
+            segments = norm_path.split('.')
+            _trie_walk(self._path_trie, segments, candidates)
+            _trie_walk(self._path_trie, segments[1:], candidates)
+        candidates.extend(self._scan)
+
+        best = None
+        for rule in candidates:
+            if (best is None or rule.index < best.index) and rule.matches(system, code, norm_path):
+                best = rule
+        if best is not None and count:
+            with self._lock:
+                self.hits[best.index] += 1
+        return best
+
+    def hit_counts(self):
+        """
+        A copy of the hit counts (rule index -> hits).
+        """
+        with self._lock:
+            return self.hits.copy()
+
+    def add_hits(self, counts):
+        """
+        Add hit counts taken from hit_counts(), e.g. for a file whose rows are reused.
+        """
+        with self._lock:
+            self.hits.update(counts)
+
+    def remove_hits(self, counts):
+        """
+        Take away hit counts added earlier, e.g. for a file that was re-checked or deleted.
+        """
+        with self._lock:
+            self.hits.subtract(counts)
+
+    def summary(self):
+        """
+        One row per rule with its hit count, for the report.
+        """
+        hits = self.hit_counts()
+        return [{'rule': rule.describe(), 'result': rule.result, 'reason': rule.reason, 'hits': hits[rule.index]}
+                for rule in self.rules]
+
+
+def compile_rules(cs_excluded):
+    """
+    Compile the codesystem-excluded config list. Already compiled rules are returned unchanged.
+
+    Raises:
+        ValueError: if a rule has no criteria or an invalid regular expression.
+    """
+    if isinstance(cs_excluded, ExclusionRules):
+        return cs_excluded
+    rules = []
+    for exc in cs_excluded or []:
+        if not isinstance(exc, dict):
+            logger.warning("Ignoring codesystem-excluded entry that is not an object: %s", exc)
+            continue
+        rules.append(ExclusionRule(len(rules), exc))
+    return ExclusionRules(rules)
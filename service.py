@@ -0,0 +1,238 @@
+import json
+import time
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from results import ResultRow
+
+logger = logging.getLogger(__name__)
+
+##
+## Validation service: a long-running local HTTP server around one TerminologyChecks,
+## so every request shares the same pooled terminology client, response cache,
+## ValueSet/designation caches and package indexes.
+##
+##   POST /validate   a FHIR resource, a Bundle (each entry.resource is validated) or
+##                    NDJSON (one resource per line); ?name= labels the rows' file column.
+##                    Returns {"results": [result rows], "summary": {...}, "elapsed_ms": n}
+##   GET  /metrics    request counts, latency percentiles, throughput and cache stats
+##   GET  /health     200 while the service is up
+##
+## Requests are handled on their own threads. Everything they share is thread-safe:
+## the endpoint pool, its cache and the ValueSet/designation LRU caches and counters are
+## lock protected, as are the exclusion rule hit counts, and each thread talks to the
+## servers through its own requests.Session. Two requests needing the same uncached
+## ValueSet at once may both expand it; the second result simply replaces the first.
+##
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_BODY_BYTES = 64 * 1024 * 1024
+LATENCY_WINDOW = 10000   # most recent requests kept for the latency percentiles
+
+
+class ServiceMetrics:
+    """
+    Thread-safe request counters and a sliding window of request latencies.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = 0
+        self.failed_requests = 0
+        self.resources = 0
+        self.rows = 0
+        self.latencies = deque(maxlen=window)
+
+    def record(self, latency, resources=0, rows=0, ok=True):
+        with self._lock:
+            self.requests += 1
+            self.failed_requests += not ok
+            self.resources += resources
+            self.rows += rows
+            self.latencies.append(latency)
+
+    def snapshot(self):
+        with self._lock:
+            uptime = time.monotonic() - self.started
+            latencies = sorted(self.latencies)
+            counts = {'requests': self.requests, 'failed_requests': self.failed_requests,
+                      'resources': self.resources, 'rows': self.rows}
+
+        def percentile(p):
+            return round(1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))], 1) if latencies else None
+
+        return {
+            'uptime_seconds': round(uptime, 1),
+            **counts,
+            'requests_per_second': round(counts['requests'] / uptime, 2) if uptime else 0.0,
+            'resources_per_second': round(counts['resources'] / uptime, 2) if uptime else 0.0,
+            'latency_ms': {
+                'mean': round(1000 * sum(latencies) / len(latencies), 1) if latencies else None,
+                'p50': percentile(0.50),
+                'p95': percentile(0.95),
+                'p99': percentile(0.99),
+                'max': round(1000 * latencies[-1], 1) if latencies else None
+            }
+        }
+
+
+def parse_body(body, content_type=''):
+    """
+    Split a request body into resources to validate.
+
+    Args:
+        body (bytes): The request body.
+        content_type (str): The request Content-Type; ndjson types skip straight to line parsing.
+
+    Returns:
+        list: (label suffix, resource dict or None if the line was not valid JSON) tuples.
+    """
+    text = body.decode('utf-8-sig')
+    if 'ndjson' not in content_type:
+        try:
+            resource = json.loads(text)
+        except json.JSONDecodeError:
+            resource = None
+        if isinstance(resource, dict):
+            if resource.get('resourceType') == 'Bundle':
+                return [(f"entry[{i}]", entry.get('resource'))
+                        for i, entry in enumerate(resource.get('entry', [])) if isinstance(entry, dict) and entry.get('resource')]
+            return [('', resource)]
+    resources = []
+    for line_no, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            resource = json.loads(line)
+        except json.JSONDecodeError:
+            resource = None
+        resources.append((f"line {line_no}", resource if isinstance(resource, dict) else None))
+    return resources
+
+
+class ValidationService(ThreadingHTTPServer):
+    """
+    An HTTP server validating posted resources with a shared TerminologyChecks.
+    """
+    daemon_threads = True
+
+    def __init__(self, checks, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self.checks = checks
+        self.metrics = ServiceMetrics()
+        super().__init__((host, port), ServiceHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def validate(self, body, content_type='', name='request'):
+        """
+        Validate every resource in a request body.
+
+        Returns:
+            tuple: (list of ResultRows, number of resources)
+        """
+        resources = parse_body(body, content_type)
+        rows = []
+        for suffix, resource in resources:
+            label = f"{name} {suffix}" if suffix else name
+            if resource is None:
+                rows.append(ResultRow(file=label, resource_id='N/A', path='File Level', result='ERROR', reason='Invalid JSON format'))
+                continue
+            try:
+                rows.extend(self.checks.check_resource(resource, label))
+            except Exception as e:
+                logger.error("Unexpected error validating %s: %s", label, e, exc_info=True)
+                rows.append(ResultRow(file=label, resource_id=resource.get('id', 'N/A'), path='File Level', result='ERROR', reason=str(e)))
+        return rows, len(resources)
+
+    def metrics_report(self):
+        pool = self.checks.endpoint
+        report = self.metrics.snapshot()
+        if hasattr(pool, 'cache_stats'):
+            report['tx_cache'] = pool.cache_stats()
+            report['tx_servers'] = pool.stats()
+        return report
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    server_version = 'FHIR-Terminology-Validator/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif path == '/metrics':
+            self._send_json(200, self.server.metrics_report())
+        else:
+            self._send_json(404, {'error': f'Unknown path {path}'})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        if url.path != '/validate':
+            self.close_connection = True   # the body is left unread
+            self._send_json(404, {'error': f'Unknown path {url.path}'})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self.server.metrics.record(time.perf_counter() - start, ok=False)
+            self._send_json(413, {'error': f'Request body larger than {MAX_BODY_BYTES} bytes'})
+            return
+        body = self.rfile.read(length)
+        name = parse_qs(url.query).get('name', ['request'])[0]
+        try:
+            rows, resources = self.server.validate(body, self.headers.get('Content-Type', ''), name)
+        except UnicodeDecodeError as e:
+            self.server.metrics.record(time.perf_counter() - start, ok=False)
+            self._send_json(400, {'error': f'Request body is not UTF-8: {e}'})
+            return
+        elapsed = time.perf_counter() - start
+        summary = {
+            'resources': resources,
+            'rows': len(rows),
+            'fail': sum(row.result == 'FAIL' for row in rows),
+            'error': sum(row.result == 'ERROR' for row in rows)
+        }
+        self.server.metrics.record(elapsed, resources, len(rows))   # before replying, so /metrics already counts it
+        self._send_json(200, {'results': [row.to_dict() for row in rows], 'summary': summary, 'elapsed_ms': round(1000 * elapsed, 1)})
+
+    def log_message(self, format, *args):
+        logger.info("%s - " + format, self.address_string(), *args)
+
+
+def serve_terminology_check(checks, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Run the validation service until interrupted.
+
+    Args:
+        checks (TerminologyChecks): Shared validation setup, kept warm across requests.
+        host (str): Interface to listen on; localhost by default.
+        port (int): Port to listen on.
+    """
+    service = ValidationService(checks, host, port)
+    print(f"Validation service listening on {service.url} (POST /validate, GET /metrics, Ctrl-C to stop)")
+    logger.info("Validation service listening on %s", service.url)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping validation service")
+    finally:
+        service.server_close()
+        logger.info("Validation service metrics: %s", service.metrics_report())
+        checks.log_stats()
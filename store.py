@@ -0,0 +1,154 @@
+import sys
+import argparse
+import logging
+from results import RESULT_HEADER
+
+logger = logging.getLogger(__name__)
+
+##
+## Parquet result store
+##
+## `main.py --store DIR` appends every run's result rows to a Parquet dataset in DIR,
+## hive-partitioned by run timestamp and terminology endpoint:
+##   DIR/run=20250101-120000/endpoint=https%3A%2F%2Ftx.example%2Ffhir/part-0.parquet
+## With several servers configured the endpoint is the run's primary (first healthy)
+## server, so --endpoint URL matches however many servers shared the work; the
+## `server` column records which server answered each row.
+## The repetitive string columns are dictionary encoded, so hundreds of runs stay
+## small and a query only reads the columns (and partitions) it needs.
+##
+##   python store.py query DIR [--by system] [--since 20250101] [--endpoint URL]
+##
+## prints failures per run and system (or file, path, endpoint, server) over time.
+## pyarrow is optional and only imported here, when a store is used.
+##
+
+PARTITION_COLUMNS = ['run', 'endpoint']
+DICTIONARY_COLUMNS = ['file', 'resource_id', 'path', 'system', 'result', 'reason', 'server']
+FAILING = ['FAIL', 'ERROR']
+GROUP_COLUMNS = ['system', 'file', 'path', 'endpoint', 'server', 'result']
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise ImportError("The Parquet result store needs pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+
+def _schema(pa):
+    fields = []
+    for key in RESULT_HEADER:
+        if key == 'status_code':
+            fields.append(pa.field(key, pa.int32()))
+        elif key in DICTIONARY_COLUMNS:
+            fields.append(pa.field(key, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(key, pa.string()))
+    return pa.schema(fields)
+
+
+def _partitioning(pa):
+    return pa.dataset.partitioning(pa.schema([(name, pa.string()) for name in PARTITION_COLUMNS]), flavor='hive')
+
+
+def endpoint_name(endpoint):
+    """
+    The endpoint partition value: the server url, or the primary (first healthy) server of a pool.
+    """
+    if hasattr(endpoint, 'primary'):
+        return endpoint.primary().url
+    return str(endpoint).rstrip('/')
+
+
+def append_results(rows, store_dir, run, endpoint):
+    """
+    Append one run's result rows to the Parquet dataset in store_dir.
+
+    Args:
+        rows (list): ResultRows of the run.
+        store_dir (str): Root folder of the dataset, created if needed.
+        run (str): Run timestamp, e.g. 20250101-120000; sorts in run order.
+        endpoint (str or EndpointPool): The terminology server(s) the run used.
+
+    Returns:
+        int: Number of rows written.
+    """
+    pa = _pyarrow()
+    schema = _schema(pa)
+    columns = {}
+    for field in schema:
+        values = [getattr(row, field.name) for row in rows]
+        if pa.types.is_integer(field.type):
+            values = [value if isinstance(value, int) else None for value in values]
+        else:
+            values = [None if value is None else str(value) for value in values]
+        columns[field.name] = pa.array(values, field.type)
+    table = pa.table(columns, schema=schema)
+    table = table.append_column('run', pa.array([run] * len(rows), pa.string()))
+    table = table.append_column('endpoint', pa.array([endpoint_name(endpoint)] * len(rows), pa.string()))
+    pa.dataset.write_dataset(table, store_dir, format='parquet', partitioning=_partitioning(pa),
+                             basename_template=f'part-{run}-{{i}}.parquet', existing_data_behavior='overwrite_or_ignore')
+    logger.info("Appended %s results for run %s to %s", len(rows), run, store_dir)
+    return len(rows)
+
+
+def failure_trend(store_dir, by='system', results=FAILING, since=None, endpoint=None):
+    """
+    Count result rows per run and `by` column, e.g. failures per code system over time.
+
+    Args:
+        store_dir (str): Root folder of the dataset.
+        by (str): Column to group on, one of GROUP_COLUMNS.
+        results (list): Result values to count; failures and errors by default.
+        since (str): Only runs at or after this timestamp (prefix), e.g. 20250101.
+        endpoint (str): Only runs against this endpoint partition.
+
+    Returns:
+        pandas.DataFrame: run, `by`, count columns, in run order.
+    """
+    pa = _pyarrow()
+    import pyarrow.compute as pc
+
+    if by not in GROUP_COLUMNS:
+        raise ValueError(f"Cannot group by {by}, expected one of {GROUP_COLUMNS}")
+    ds = pa.dataset
+    dataset = ds.dataset(store_dir, format='parquet', partitioning=_partitioning(pa))
+    condition = ds.field('result').isin(list(results))
+    if since:
+        condition = condition & (ds.field('run') >= since)
+    if endpoint:
+        condition = condition & (ds.field('endpoint') == endpoint)
+    table = dataset.to_table(columns=list(dict.fromkeys(['run', by, 'result'])), filter=condition)
+    # Group on plain strings; the dictionaries differ from file to file
+    table = pa.table({'run': pc.cast(table['run'], pa.string()), by: pc.cast(table[by], pa.string())})
+    trend = table.group_by(['run', by]).aggregate([('run', 'count')]).rename_columns(['run', by, 'count'])
+    return trend.to_pandas().sort_values(['run', 'count', by], ascending=[True, False, True]).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the Parquet result store")
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help="Count failures per run over time")
+    query.add_argument("store", help="Result store folder (main.py --store)")
+    query.add_argument("--by", help="Column to group on", choices=GROUP_COLUMNS, default='system')
+    query.add_argument("--result", help="Result values to count", nargs='+', default=FAILING)
+    query.add_argument("--since", help="Only runs at or after this timestamp, e.g. 20250101")
+    query.add_argument("--endpoint", help="Only runs against this terminology server")
+    query.add_argument("-o", "--output", help="Write the counts to this csv file instead of printing them")
+    args = parser.parse_args()
+
+    trend = failure_trend(args.store, args.by, args.result, args.since, args.endpoint)
+    if args.output:
+        trend.to_csv(args.output, index=False)
+    elif trend.empty:
+        print("No matching results")
+    else:
+        print(trend.to_string(index=False))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,144 @@
-import pandas as pd
 import unittest
+import subprocess
+import sys
+import time
+import json
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 from utils import get_config, check_path
 import os
 from tester import run_capability_test
 from tester import validate_example_code, get_json_files, search_json_file
+from tester import is_terminology_capability
+from results import ResultRow, RESULT_HEADER, results_to_dataframe
+from bench import measure_result_memory
+from rules import compile_rules
+from bindings import load_bindings, binding_paths, ValueSetCache
+from display import DesignationCache, normalise_display, check_displays
+from getter import get_npm_packages
+from txindex import ensure_index
+from elements import load_element_schema, WALK, LEAF
+from txpool import EndpointPool
+from tester import TerminologyChecks, run_terminology_check
+from watch import watch_terminology_check
+from service import ValidationService
+from concurrent.futures import ThreadPoolExecutor
+import urllib.request
+from diff import write_results_csv, diff_runs, diff_exit_status, DIFF_HEADER
+import csv
+import importlib.util
+from store import append_results, failure_trend
+from logsetup import setup_logging, SamplingFilter, DeferredQueueHandler
+import logging
+import io
+import tarfile
 
 
 
+class FakeTxServer:
+    """
+        A local stand-in for a FHIR terminology server, for tests that can't reach the real one.
+        valuesets maps a ValueSet url to a list of (system, code); codesystems maps a system to its codes.
+    """
+    def __init__(self, valuesets=None, codesystems=None, designations=None, batch=True):
+        self.valuesets = valuesets or {}
+        self.codesystems = codesystems or {}
+        self.designations = designations or {}
+        self.batch = batch
+        self.fail_next = []   # statuses returned, in order, before answering operations normally
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                fake.requests.append((url.path, params))
+                self.reply(*fake.handle(url.path, params))
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                fake.requests.append((self.path, body.get('type')))
+                if fake.fail_next:
+                    self.reply(fake.fail_next.pop(0), {'resourceType': 'OperationOutcome'})
+                    return
+                self.reply(*fake.handle_batch(body))
+
+            def reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/fhir+json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}/fhir"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def parameters(result, display=None, message=None):
+        params = [{'name': 'result', 'valueBoolean': result}]
+        if display:
+            params.append({'name': 'display', 'valueString': display})
+        if message:
+            params.append({'name': 'message', 'valueString': message})
+        return {'resourceType': 'Parameters', 'parameter': params}
+
+    def handle(self, path, params):
+        if path.endswith('/metadata'):
+            return 200, {'resourceType': 'CapabilityStatement', 'fhirVersion': '4.0.1',
+                         'instantiates': ['http://hl7.org/fhir/CapabilityStatement/terminology-server']}
+        if self.fail_next:
+            return self.fail_next.pop(0), {'resourceType': 'OperationOutcome'}
+        if path.endswith('/ValueSet/$expand'):
+            if params['url'] not in self.valuesets:
+                return 404, {'resourceType': 'OperationOutcome'}
+            codes = self.valuesets[params['url']]
+            offset, count = int(params.get('offset', 0)), int(params.get('count', 1000))
+            contains = [{'system': sys_, 'code': code} for sys_, code in codes[offset:offset + count]]
+            return 200, {'resourceType': 'ValueSet', 'expansion': {'total': len(codes), 'offset': offset, 'contains': contains}}
+        if path.endswith('/ValueSet/$validate-code'):
+            codes = self.valuesets.get(params['url'], [])
+            return 200, self.parameters((params.get('system'), params.get('code')) in codes)
+        if path.endswith('/CodeSystem/$validate-code'):
+            codes = self.codesystems.get(params.get('url'), {})
+            code = params.get('code')
+            if code in codes:
+                return 200, self.parameters(True, codes[code])
+            return 200, self.parameters(False, message=f"Unknown code '{code}'")
+        if path.endswith('/CodeSystem/$lookup'):
+            key = (params.get('system'), params.get('code'))
+            if key not in self.designations:
+                return 404, {'resourceType': 'OperationOutcome'}
+            display, *others = self.designations[key]
+            parameter = [{'name': 'display', 'valueString': display}]
+            parameter += [{'name': 'designation', 'part': [{'name': 'language', 'valueCode': 'en-AU'},
+                                                           {'name': 'value', 'valueString': d}]} for d in others]
+            return 200, {'resourceType': 'Parameters', 'parameter': parameter}
+        return 404, {'resourceType': 'OperationOutcome'}
+
+    def handle_batch(self, bundle):
+        if not self.batch or bundle.get('type') != 'batch':
+            return 400, {'resourceType': 'OperationOutcome'}
+        entries = []
+        for entry in bundle.get('entry', []):
+            url = urlparse('/fhir/' + entry['request']['url'])
+            status, body = self.handle(url.path, {k: v[0] for k, v in parse_qs(url.query).items()})
+            entries.append({'resource': body, 'response': {'status': f'{status}'}})
+        return 200, {'resourceType': 'Bundle', 'type': 'batch-response', 'entry': entries}
+
+
 class TestValueSetTester(unittest.TestCase):
     def setUp(self):
         ## Shared config
@@ -40,13 +172,7 @@ class TestValueSetTester(unittest.TestCase):
             results = search_json_file(self.endpoint, cs_excluded, ex)
             all_results.extend(results)
 
-        header = ['file','resourceid','code','display','system','text','result','reason']
-
-        for result in all_results:
-            for key in header:
-                if key not in result:
-                    result[key] = ''  # Provide a default value
-        df_results = pd.DataFrame(all_results,columns=header)
+        df_results = results_to_dataframe(all_results)
         self.assertFalse((df_results['result']=='FAIL').any())
         
 
@@ -81,5 +207,955 @@ class TestValueSetTester(unittest.TestCase):
             self.assertEqual(test['status_code'], result_status['status_code'])
             self.assertEqual(test['result'], result_status['result'])
 
+
+class TestStartup(unittest.TestCase):
+    HEAVY_MODULES = ['pandas', 'numpy', 'fhirpathpy', 'antlr4', 'requests']
+
+    def test_main_import_is_light(self):
+        """
+            Importing main must not pull in pandas, numpy, fhirpathpy or requests
+        """
+        code = ("import sys, main; "
+                f"print(','.join(m for m in {self.HEAVY_MODULES!r} if m in sys.modules))")
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), '')
+
+    def test_help_startup_time(self):
+        """
+            Measure `main.py -h` wall time and guard it against regressions
+        """
+        start = time.perf_counter()
+        subprocess.run([sys.executable, 'main.py', '-h'], capture_output=True, check=True)
+        elapsed = time.perf_counter() - start
+        self.assertLess(elapsed, 2.0)
+
+    def test_capability_check_without_fhirpath(self):
+        """
+            The capability check reads instantiates/fhirVersion directly
+        """
+        data = {'resourceType': 'CapabilityStatement', 'fhirVersion': '4.0.1',
+                'instantiates': ['http://hl7.org/fhir/CapabilityStatement/terminology-server']}
+        self.assertTrue(is_terminology_capability(data))
+        self.assertFalse(is_terminology_capability(dict(data, fhirVersion='5.0.0')))
+        self.assertFalse(is_terminology_capability(dict(data, instantiates=[])))
+        self.assertFalse(is_terminology_capability(None))
+
+
+class TestResultRow(unittest.TestCase):
+    def test_row_fields_and_interning(self):
+        """
+            ResultRow exposes the report columns, supports item access and interns repeated strings
+        """
+        a = ResultRow(file='a.json', system=''.join(['http://loinc.org']), result='PASS')
+        b = ResultRow(file='b.json', system=''.join(['http://loinc.org']), result='PASS')
+        self.assertIs(a.system, b.system)
+        self.assertEqual(a['result'], 'PASS')
+        a['reason'] = 'Code is valid.'
+        self.assertEqual(a.reason, 'Code is valid.')
+        self.assertEqual(list(a.to_dict()), RESULT_HEADER)
+        with self.assertRaises(KeyError):
+            a['display'] = 'x'
+        df = results_to_dataframe([a, b])
+        self.assertEqual(list(df.columns), RESULT_HEADER)
+        self.assertEqual(len(df), 2)
+
+    def test_result_memory_saving(self):
+        """
+            Measure the memory held by compact rows against dict rows
+        """
+        dict_bytes, compact_bytes = measure_result_memory(20000)
+        self.assertLess(compact_bytes, dict_bytes * 0.6)
+
+
+class TestExclusionRules(unittest.TestCase):
+    def setUp(self):
+        self.rules = compile_rules([
+            {'uri': 'http://www.mims.com.au/codes', 'result': 'MANUAL', 'reason': 'mims'},
+            {'uri-prefix': 'http://example.', 'result': 'IGNORED', 'reason': 'example'},
+            {'uri-regex': r'^urn:oid:1\.2\.36\.', 'code-regex': r'\d+', 'result': 'MANUAL', 'reason': 'oid'},
+            {'path': 'component.code', 'result': 'IGNORED', 'reason': 'components'},
+            {'uri': 'http://loinc.org', 'code': 'LP-1', 'result': 'IGNORED', 'reason': 'part'},
+        ])
+
+    def test_rule_matching(self):
+        """
+            Exact, prefix, regex and path rules match with first-listed precedence
+        """
+        self.assertEqual(self.rules.match('http://www.mims.com.au/codes', '1', 'X.code.coding[0]').reason, 'mims')
+        self.assertEqual(self.rules.match('http://example.org/cs', 'a', 'X.code.coding[0]').reason, 'example')
+        self.assertEqual(self.rules.match('urn:oid:1.2.36.1.2001', '123', 'X.code.coding[0]').reason, 'oid')
+        self.assertIsNone(self.rules.match('urn:oid:1.2.36.1.2001', 'abc', 'X.code.coding[0]'))
+        self.assertEqual(self.rules.match('http://snomed.info/sct', '1', 'Observation.component[1].code.coding[0]').reason, 'components')
+        self.assertEqual(self.rules.match('http://example.org/cs', '1', 'Observation.component[1].code.coding[0]').reason, 'example')
+        self.assertIsNone(self.rules.match('http://snomed.info/sct', '1', 'Observation.componentCode.coding[0]'))
+        self.assertEqual(self.rules.match('http://loinc.org', 'LP-1', 'X.code.coding[0]').reason, 'part')
+        self.assertIsNone(self.rules.match('http://loinc.org', '1234-5', 'X.code.coding[0]'))
+        self.assertEqual([row['hits'] for row in self.rules.summary()], [1, 2, 1, 1, 1])
+
+    def test_invalid_rules(self):
+        """
+            Rules without criteria or with a bad regex fail at compile time
+        """
+        with self.assertRaises(ValueError):
+            compile_rules([{'result': 'IGNORED'}])
+        with self.assertRaises(ValueError):
+            compile_rules([{'uri-regex': '(', 'result': 'IGNORED'}])
+
+    def test_excluded_code_not_sent(self):
+        """
+            An excluded coding returns the configured result without calling the server
+        """
+        result = validate_example_code('f.json', 'http://127.0.0.1:9/fhir', self.rules, 'http://example.org/cs', 'a', None, None, 'r1', 'Observation.code.coding[0]')
+        self.assertEqual(result['result'], 'IGNORED')
+        self.assertIsNone(result['status_code'])
+
+
+class TestBindings(unittest.TestCase):
+    PROFILE = 'http://example.org/StructureDefinition/test-observation'
+    SNOMED = 'http://snomed.info/sct'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.package = os.path.join(self.tmpdir, 'node_modules', 'example.pkg')
+        os.makedirs(self.package)
+        sd = {'resourceType': 'StructureDefinition', 'url': self.PROFILE, 'snapshot': {'element': [
+            {'id': 'Observation.code', 'path': 'Observation.code',
+             'binding': {'strength': 'required', 'valueSet': 'http://example.org/vs/small'}},
+            {'id': 'Observation.value[x]', 'path': 'Observation.value[x]',
+             'binding': {'strength': 'extensible', 'valueSet': 'http://example.org/vs/big'}},
+            {'id': 'Observation.category:lab', 'path': 'Observation.category',
+             'binding': {'strength': 'required', 'valueSet': 'http://example.org/vs/small'}},
+        ]}}
+        with open(os.path.join(self.package, 'StructureDefinition-test-observation.json'), 'w') as f:
+            json.dump(sd, f)
+        self.server = FakeTxServer(
+            valuesets={'http://example.org/vs/small': [(self.SNOMED, str(i)) for i in range(5)],
+                       'http://example.org/vs/big': [(self.SNOMED, str(i)) for i in range(50)]},
+            codesystems={self.SNOMED: {str(i): f'Concept {i}' for i in range(100)}})
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_binding_paths(self):
+        self.assertEqual(binding_paths('Observation.valueCodeableConcept.coding[1]'),
+                         ['Observation.valueCodeableConcept', 'Observation.value'])
+        self.assertEqual(binding_paths('Observation.component[2].code.coding[0]'), ['Observation.component.code'])
+
+    def test_expand_once_and_fallback(self):
+        """
+            Small ValueSets are expanded once with paging, large ones are checked on the server
+        """
+        cache = ValueSetCache(self.server.endpoint, max_size=20, page_size=2)
+        self.assertEqual(cache.contains('http://example.org/vs/small', self.SNOMED, '4'), (True, None, self.server.endpoint))
+        self.assertEqual(cache.contains('http://example.org/vs/small', self.SNOMED, '9'), (False, None, self.server.endpoint))
+        self.assertEqual(cache.stats['expand_requests'], 3)
+        self.assertTrue(cache.contains('http://example.org/vs/big', self.SNOMED, '30')[0])
+        self.assertFalse(cache.contains('http://example.org/vs/big', self.SNOMED, '70')[0])
+        self.assertTrue(cache.contains('http://example.org/vs/big', self.SNOMED, '30')[0])
+        self.assertEqual(cache.stats['server_checks'], 2)
+
+    def test_transient_errors_not_cached(self):
+        """
+            A failed $expand or $validate-code is asked again on the next use; only definite answers are cached
+        """
+        small, big = 'http://example.org/vs/small', 'http://example.org/vs/big'
+        cache = ValueSetCache(self.server.endpoint, max_size=20)
+        self.server.fail_next = [503]   # $expand fails, the same call falls back to $validate-code
+        self.assertEqual(cache.contains(small, self.SNOMED, '4')[0], True)
+        self.assertEqual(cache.contains(small, self.SNOMED, '4')[0], True)
+        self.assertEqual(cache.stats['expansions'], 1)
+        self.server.fail_next = [429, 429]   # $expand and the $validate-code fallback
+        self.assertIsNone(cache.contains(big, self.SNOMED, '30')[0])
+        self.assertTrue(cache.contains(big, self.SNOMED, '30')[0])
+        self.assertTrue(cache.contains(big, self.SNOMED, '30')[0])
+        self.assertEqual(cache.stats['server_checks'], 3)
+        cache.contains('http://example.org/vs/unknown', self.SNOMED, '1')   # 404: not expandable, remembered
+        cache.contains('http://example.org/vs/unknown', self.SNOMED, '1')
+        expands = [params['url'] for path, params in self.server.requests if path.endswith('$expand')]
+        self.assertEqual(expands.count('http://example.org/vs/unknown'), 1)
+
+    def test_validation_cache_is_bounded(self):
+        cache = ValueSetCache(self.server.endpoint, max_size=20, max_validations=2)
+        for code in ('30', '31', '32'):
+            cache.contains('http://example.org/vs/big', self.SNOMED, code)
+        self.assertEqual(len(cache.validated), 2)
+        self.assertNotIn(('http://example.org/vs/big', self.SNOMED, '30'), cache.validated)
+
+    def test_search_json_file_with_bindings(self):
+        """
+            Codings in profiled instances get a binding result row per bound ValueSet
+        """
+        resource = {'resourceType': 'Observation', 'id': 'obs1', 'meta': {'profile': [self.PROFILE]},
+                    'code': {'coding': [{'system': self.SNOMED, 'code': '3'}]},
+                    'category': [{'coding': [{'system': self.SNOMED, 'code': '99'}]}],
+                    'valueCodeableConcept': {'coding': [{'system': self.SNOMED, 'code': '60'}]}}
+        instance = os.path.join(self.tmpdir, 'obs1.json')
+        with open(instance, 'w') as f:
+            json.dump(resource, f)
+        index = load_bindings([self.package])
+        cache = ValueSetCache(self.server.endpoint, max_size=20)
+        results = search_json_file(self.server.endpoint, [], instance, index, cache)
+        by_path = {r.path: r.result for r in results}
+        self.assertEqual(by_path['Observation.code.coding[0]'], 'PASS')
+        self.assertEqual(by_path['Observation.code.coding[0] (binding)'], 'PASS')
+        self.assertEqual(by_path['Observation.valueCodeableConcept.coding[0] (binding)'], 'WARNING')
+        self.assertNotIn('Observation.category[0].coding[0] (binding)', by_path)
+        self.assertEqual({r.server for r in results if r.path.endswith('(binding)')}, {self.server.endpoint})
+
+
+class TestDisplay(unittest.TestCase):
+    SNOMED = 'http://snomed.info/sct'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        codes = {'1': 'Hemoglobin', '2': 'Oedema', '3': 'Fever'}
+        self.designations = {(self.SNOMED, '1'): ['Hemoglobin', 'Haemoglobin'],
+                             (self.SNOMED, '2'): ['Oedema'], (self.SNOMED, '3'): ['Fever']}
+        self.resource = {'resourceType': 'Observation', 'id': 'obs1',
+                         'code': {'coding': [{'system': self.SNOMED, 'code': '1', 'display': 'haemoglobin '}]},
+                         'category': [{'coding': [{'system': self.SNOMED, 'code': '2', 'display': 'Edema'}]},
+                                      {'coding': [{'system': self.SNOMED, 'code': '3', 'display': 'Fever'},
+                                                  {'system': self.SNOMED, 'code': '1', 'display': 'Hemoglobin'}]}]}
+        self.instance = os.path.join(self.tmpdir, 'obs1.json')
+        with open(self.instance, 'w') as f:
+            json.dump(self.resource, f)
+        self.codesystems = {self.SNOMED: codes}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, batch):
+        server = FakeTxServer(codesystems=self.codesystems, designations=self.designations, batch=batch)
+        try:
+            cache = DesignationCache(server.endpoint)
+            results = search_json_file(server.endpoint, [], self.instance, designation_cache=cache)
+            lookups = [r for r in server.requests if r[0].endswith('$lookup')]
+            return {r.path: r.result for r in results if r.path.endswith('(display)')}, cache, lookups
+        finally:
+            server.close()
+
+    def test_normalise_display(self):
+        self.assertEqual(normalise_display('  Haemoglobin\tMass '), 'haemoglobin mass')
+
+    def test_display_check_batched(self):
+        """
+            Any designation is accepted, and each distinct code is looked up once in one batch
+        """
+        displays, cache, lookups = self._run(batch=True)
+        self.assertEqual(displays['Observation.code.coding[0] (display)'], 'PASS')
+        self.assertEqual(displays['Observation.category[0].coding[0] (display)'], 'FAIL')
+        self.assertEqual(displays['Observation.category[1].coding[1] (display)'], 'PASS')
+        self.assertEqual(cache.stats['batch_requests'], 1)
+        self.assertEqual(cache.stats['codes'], 3)
+        self.assertEqual(lookups, [])
+
+    def test_display_check_without_batch_support(self):
+        """
+            Falls back to one $lookup per distinct code if the server rejects batches
+        """
+        displays, cache, lookups = self._run(batch=False)
+        self.assertEqual(displays['Observation.category[0].coding[0] (display)'], 'FAIL')
+        self.assertEqual(len(lookups), 3)
+
+    def test_failed_lookups_not_cached(self):
+        """
+            A transient batch failure is an ERROR for that check only: batching stays on and the codes
+            are looked up again next time. Unknown codes are not cached either, and the cache is bounded.
+        """
+        server = FakeTxServer(codesystems=self.codesystems, designations=self.designations)
+        self.addCleanup(server.close)
+        cache = DesignationCache(server.endpoint, max_codes=2)
+        rows = [ResultRow(file='f.json', resource_id='r1', path=f'X.code.coding[{i}]', system=self.SNOMED, code=code,
+                          display_provided=display, result='PASS') for i, (code, display) in enumerate([('1', 'Haemoglobin'), ('2', 'Edema'), ('3', 'Fever')])]
+        server.fail_next = [503]
+        self.assertEqual([r.result for r in check_displays(rows, cache)], ['ERROR', 'ERROR', 'ERROR'])
+        self.assertTrue(cache.batch_supported)
+        self.assertEqual(len(cache.designations), 0)
+        self.assertEqual([r.result for r in check_displays(rows, cache)], ['PASS', 'FAIL', 'PASS'])
+        self.assertEqual(len(cache.designations), 2)
+        self.assertEqual(cache.get(self.SNOMED, '99'), (None, server.endpoint))
+        self.assertNotIn((self.SNOMED, '99'), cache.designations)
+        self.assertEqual(cache.stats['batch_requests'], 3)
+
+
+class TestPackageFetch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.registry = os.path.join(self.tmpdir, 'registry')
+        os.makedirs(self.registry)
+        self.packages = [{'title': f'Package {i}', 'name': f'example.pkg{i}', 'version': '1.0.0'} for i in range(3)]
+        for package in self.packages:
+            self._write_tarball(package['name'], package['version'])
+        self.config_file = os.path.join(self.tmpdir, 'config.json')
+        with open(self.config_file, 'w') as f:
+            json.dump({'packages': self.packages}, f)
+        self.data_dir = os.path.join(self.tmpdir, 'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_tarball(self, name, version):
+        with tarfile.open(os.path.join(self.registry, f'{name}-{version}.tgz'), 'w:gz') as tar:
+            for member, content in [('package/package.json', {'name': name, 'version': version}),
+                                    ('package/StructureDefinition-x.json', {'resourceType': 'StructureDefinition'}),
+                                    ('../escape.json', {})]:
+                data = json.dumps(content).encode()
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+    def test_fetch_from_local_registry_and_cache(self):
+        """
+            Packages are extracted into node_modules and reused from the cache after a clean
+        """
+        paths = get_npm_packages('dirty', self.data_dir, self.config_file, registry=self.registry)
+        self.assertEqual([os.path.basename(p) for p in paths], [p['name'] for p in self.packages])
+        for path in paths:
+            self.assertTrue(os.path.isfile(os.path.join(path, 'package.json')))
+            self.assertTrue(os.path.isfile(os.path.join(path, 'StructureDefinition-x.json')))
+        self.assertFalse(os.path.exists(os.path.join(self.data_dir, 'npm', 'node_modules', 'escape.json')))
+        with open(os.path.join(self.data_dir, 'package-cache', 'index.json')) as f:
+            self.assertEqual(set(json.load(f)), {f"{p['name']}@1.0.0" for p in self.packages})
+
+        # A clean run re-extracts from the cache without the registry
+        shutil.rmtree(self.registry)
+        paths = get_npm_packages('clean', self.data_dir, self.config_file, registry=self.registry)
+        for path in paths:
+            self.assertTrue(os.path.isfile(os.path.join(path, 'package.json')))
+
+
+class TestTerminologyIndex(unittest.TestCase):
+    CS = 'http://example.org/CodeSystem/colours'
+    FRAGMENT = 'http://example.org/CodeSystem/shapes'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.package = os.path.join(self.tmpdir, 'npm', 'node_modules', 'example.pkg')
+        os.makedirs(self.package)
+        resources = [
+            {'resourceType': 'CodeSystem', 'url': self.CS, 'content': 'complete', 'concept': [
+                {'code': 'red', 'display': 'Red', 'concept': [{'code': 'crimson', 'display': 'Crimson'}]},
+                {'code': 'blue', 'display': 'Blue'}]},
+            {'resourceType': 'CodeSystem', 'url': self.FRAGMENT, 'content': 'fragment', 'concept': [{'code': 'square'}]},
+            {'resourceType': 'ValueSet', 'url': 'http://example.org/ValueSet/reds',
+             'compose': {'include': [{'system': self.CS, 'concept': [{'code': 'red'}, {'code': 'crimson'}]}]}},
+            {'resourceType': 'ValueSet', 'url': 'http://example.org/ValueSet/all-colours',
+             'compose': {'include': [{'system': self.CS, 'filter': [{'property': 'concept', 'op': 'is-a', 'value': 'red'}]}]}},
+        ]
+        for i, resource in enumerate(resources):
+            with open(os.path.join(self.package, f'resource-{i}.json'), 'w') as f:
+                json.dump(resource, f)
+        self._install('1.0.0')
+
+    def _install(self, version):
+        with open(os.path.join(self.package, 'package.json'), 'w') as f:
+            json.dump({'name': 'example.pkg', 'version': version}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookups(self):
+        index = ensure_index([self.package])
+        self.assertEqual(index.code_status(self.CS, 'crimson'), (True, 'Crimson'))
+        self.assertEqual(index.code_status(self.CS, 'green'), (False, None))
+        self.assertEqual(index.code_status(self.FRAGMENT, 'square'), (True, None))
+        self.assertIsNone(index.code_status(self.FRAGMENT, 'circle'))
+        self.assertIsNone(index.code_status('http://snomed.info/sct', '1'))
+        self.assertTrue(index.valueset_contains('http://example.org/ValueSet/reds|1.0', self.CS, 'crimson'))
+        self.assertFalse(index.valueset_contains('http://example.org/ValueSet/reds', self.CS, 'blue'))
+        self.assertIsNone(index.valueset_contains('http://example.org/ValueSet/all-colours', self.CS, 'red'))
+        index.close()
+
+    def test_rebuild_only_when_packages_change(self):
+        index = ensure_index([self.package])
+        index_file = index.index_file
+        index.close()
+        built = os.stat(index_file).st_mtime_ns
+        time.sleep(0.01)
+        ensure_index([self.package]).close()
+        self.assertEqual(os.stat(index_file).st_mtime_ns, built)
+        self._install('1.0.1')
+        ensure_index([self.package]).close()
+        self.assertNotEqual(os.stat(index_file).st_mtime_ns, built)
+
+    def test_rebuild_when_missing_package_arrives(self):
+        """
+            A package whose download failed is not in the index; the index is rebuilt once it is installed
+        """
+        late = os.path.join(self.tmpdir, 'npm', 'node_modules', 'late.pkg')
+        index = ensure_index([self.package, late])
+        self.assertIsNone(index.code_status('http://example.org/CodeSystem/late', 'a'))
+        index.close()
+        os.makedirs(late)
+        with open(os.path.join(late, 'package.json'), 'w') as f:
+            json.dump({'name': 'late.pkg', 'version': '1.0.0'}, f)
+        with open(os.path.join(late, 'CodeSystem-late.json'), 'w') as f:
+            json.dump({'resourceType': 'CodeSystem', 'url': 'http://example.org/CodeSystem/late', 'content': 'complete',
+                       'concept': [{'code': 'a'}]}, f)
+        index = ensure_index([self.package, late])
+        self.assertEqual(index.code_status('http://example.org/CodeSystem/late', 'a'), (True, None))
+        index.close()
+
+    def test_validate_code_from_index(self):
+        """
+            Codes from IG package CodeSystems are decided without calling the server
+        """
+        index = ensure_index([self.package])
+        unreachable = 'http://127.0.0.1:9/fhir'
+        passed = validate_example_code('f.json', unreachable, [], self.CS, 'blue', 'Blue', None, 'r1', 'X.code.coding[0]', index)
+        failed = validate_example_code('f.json', unreachable, [], self.CS, 'green', None, None, 'r1', 'X.code.coding[0]', index)
+        self.assertEqual((passed['result'], failed['result']), ('PASS', 'FAIL'))
+        missing = validate_example_code('f.json', unreachable, [], self.CS, None, None, None, 'r1', 'X.code.coding[0]', index)
+        self.assertEqual(missing['result'], 'ERROR')
+        self.assertNotIn("'None'", missing['reason'])
+        index.close()
+
+
+def observation_structure_definition():
+    """
+        A cut-down Observation profile snapshot for schema-guided extraction tests
+    """
+    def element(path, *types, **extra):
+        return dict({'id': path, 'path': path, 'type': [{'code': t} for t in types]}, **extra)
+    return {'resourceType': 'StructureDefinition', 'url': 'http://example.org/StructureDefinition/obs',
+            'kind': 'resource', 'type': 'Observation', 'snapshot': {'element': [
+                element('Observation'), element('Observation.meta', 'Meta'), element('Observation.text', 'Narrative'),
+                element('Observation.contained', 'Resource'), element('Observation.extension', 'Extension'),
+                element('Observation.status', 'code'), element('Observation.category', 'CodeableConcept'),
+                element('Observation.code', 'CodeableConcept'), element('Observation.subject', 'Reference'),
+                element('Observation.effective[x]', 'dateTime', 'Period'),
+                element('Observation.value[x]', 'Quantity', 'CodeableConcept', 'string'),
+                element('Observation.note', 'Annotation'), element('Observation.component', 'BackboneElement'),
+                element('Observation.component.code', 'CodeableConcept'),
+                element('Observation.component.value[x]', 'Quantity', 'CodeableConcept'),
+                element('Observation.component.component', contentReference='#Observation.component')]}}
+
+
+class TestSchemaGuidedExtraction(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.package = os.path.join(self.tmpdir, 'example.pkg')
+        os.makedirs(self.package)
+        with open(os.path.join(self.package, 'StructureDefinition-obs.json'), 'w') as f:
+            json.dump(observation_structure_definition(), f)
+        with open(os.path.join(os.getcwd(), 'config', 'examples', 'gramstain.json')) as f:
+            resource = json.load(f)
+        coding = {'system': 'http://snomed.info/sct', 'code': '1', 'display': 'One'}
+        resource['meta']['extension'] = [{'url': 'x', 'valueCodeableConcept': {'coding': [coding]}}]
+        resource['effectivePeriod'] = {'start': '2021', '_start': {'extension': [{'url': 'y', 'valueCodeableConcept': {'coding': [{'display': 'No code'}]}}]}}
+        resource['component'] = [{'code': {'coding': [coding], 'text': 'c'}, 'valueQuantity': {'value': 1},
+                                  'component': [{'code': {'coding': [], 'text': 'text only'}}]}]
+        resource['contained'] = [{'resourceType': 'Observation', 'id': 'inner', 'code': {'coding': [coding]}},
+                                 {'resourceType': 'Condition', 'id': 'cond', 'code': {'coding': [coding]}}]
+        resource['subject']['identifier'] = {'type': {'coding': [coding]}}
+        resource['unknownElement'] = {'coding': [coding]}
+        self.instance = os.path.join(self.tmpdir, 'obs.json')
+        with open(self.instance, 'w') as f:
+            json.dump(resource, f)
+        self.rules = [{'uri-regex': '.*', 'result': 'IGNORED', 'reason': 'offline'}]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_schema_paths(self):
+        schema = load_element_schema([self.package])['Observation']
+        self.assertEqual(schema.kind('Observation.valueCodeableConcept'), WALK)
+        self.assertEqual(schema.kind('Observation.status'), LEAF)
+        self.assertEqual(schema.kind('Observation.valueString'), LEAF)
+        self.assertEqual(schema.aliases['Observation.component.component'], 'Observation.component')
+
+    def test_guided_matches_full_walk(self):
+        """
+            Schema-guided extraction gives exactly the rows of the full walk
+        """
+        full = search_json_file('http://127.0.0.1:9/fhir', self.rules, self.instance)
+        guided = search_json_file('http://127.0.0.1:9/fhir', self.rules, self.instance,
+                                  element_schema=load_element_schema([self.package]))
+        self.assertGreater(len(full), 10)
+        self.assertEqual(guided, full)
+
+
+class TestEndpointPool(unittest.TestCase):
+    SNOMED = 'http://snomed.info/sct'
+    LOINC = 'http://loinc.org'
+
+    def setUp(self):
+        codesystems = {self.SNOMED: {'1': 'One'}, self.LOINC: {'1234-5': 'Test'}}
+        self.servers = [FakeTxServer(codesystems=codesystems) for _ in range(2)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def _validate(self, pool, system, code):
+        return validate_example_code('f.json', pool, [], system, code, None, None, 'r1', 'X.code.coding[0]')
+
+    def test_error_responses_not_cached(self):
+        """
+            A 429 is reported as an ERROR but not cached, so the next use of the code asks again;
+            the 200 answer is then served from the cache
+        """
+        server = self.servers[0]
+        pool = EndpointPool.from_config(server.endpoint)
+        server.fail_next = [429]
+        self.assertEqual(self._validate(pool, self.SNOMED, '1')['result'], 'ERROR')
+        self.assertEqual(self._validate(pool, self.SNOMED, '1')['result'], 'PASS')
+        cached = self._validate(pool, self.SNOMED, '1')
+        self.assertEqual((cached['result'], cached['status_code'], cached['server']), ('PASS', 200, server.endpoint))
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(pool.cache_stats()['hits'], 1)
+
+    def test_cache_is_bounded(self):
+        pool = EndpointPool.from_config(self.servers[0].endpoint)
+        pool.cache_size = 2
+        for code in ('1', '2', '3'):
+            self._validate(pool, self.SNOMED, code)
+        self.assertEqual(list(pool.cache), [('CodeSystem/$validate-code', self.SNOMED, '2'), ('CodeSystem/$validate-code', self.SNOMED, '3')])
+
+    def test_capability_check_drops_dead_servers(self):
+        pool = EndpointPool.from_config([{'endpoint': s.endpoint} for s in self.servers] + [{'endpoint': 'http://127.0.0.1:9/fhir'}], cache=False)
+        from tester import run_capability_test
+        healthy = pool.check_capabilities(run_capability_test)
+        self.assertEqual([ep.url for ep in healthy], [s.endpoint for s in self.servers])
+        servers = {self._validate(pool, self.SNOMED, '1')['server'] for _ in range(4)}
+        self.assertEqual(servers, {s.endpoint for s in self.servers})
+
+    def test_capability_check_times_out_hung_server(self):
+        """
+            A server that accepts connections but never answers is marked unhealthy after the timeout
+        """
+        import socket
+        from functools import partial
+        from tester import run_capability_test
+        hung = socket.socket()
+        hung.bind(('127.0.0.1', 0))
+        hung.listen()
+        self.addCleanup(hung.close)
+        hung_url = f"http://127.0.0.1:{hung.getsockname()[1]}/fhir"
+        pool = EndpointPool.from_config([{'endpoint': hung_url}, {'endpoint': self.servers[0].endpoint}], cache=False)
+        start = time.perf_counter()
+        healthy = pool.check_capabilities(partial(run_capability_test, timeout=0.5))
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual([ep.url for ep in healthy], [self.servers[0].endpoint])
+        self.assertEqual(pool.endpoints[0].capability_status, 408)
+
+    def test_binding_and_display_traffic_uses_pool(self):
+        """
+            ValueSet and $lookup calls are spread over the pool and fail over, and their rows record the server
+        """
+        vs = 'http://example.org/vs/small'
+        servers = [FakeTxServer(valuesets={vs: [(self.SNOMED, '1')]}, designations={(self.SNOMED, c): [f'Concept {c}'] for c in '1234'})
+                   for _ in range(2)]
+        for server in servers:
+            self.addCleanup(server.close)
+        endpoints = [s.endpoint for s in servers]
+        pool = EndpointPool.from_config([{'endpoint': url} for url in endpoints], cache=False)
+        vs_cache = ValueSetCache(pool, max_size=0)   # too large to expand: one ValueSet/$validate-code per code
+        answers = [vs_cache.contains(vs, self.SNOMED, code) for code in '12']
+        self.assertEqual([a[0] for a in answers], [True, False])
+        self.assertEqual({a[2] for a in answers}, set(endpoints))
+        designations = DesignationCache(pool, batch_size=1)
+        rows = [ResultRow(file='f.json', resource_id='r1', path=f'X.code.coding[{i}]', system=self.SNOMED, code=c,
+                          display_provided=f'Concept {c}', result='PASS') for i, c in enumerate('12')]
+        displays = check_displays(rows, designations)
+        self.assertEqual([r.result for r in displays], ['PASS', 'PASS'])
+        self.assertEqual({r.server for r in displays}, set(endpoints))
+        servers[0].close()
+        self.assertEqual(vs_cache.contains(vs, self.SNOMED, '3')[2], endpoints[1])
+        self.assertEqual(designations.get(self.SNOMED, '4'), ({'concept 4'}, endpoints[1]))
+
+    def test_weighted_balancing_and_routing(self):
+        """
+            Traffic is split by weight, and routed code systems go to their server
+        """
+        pool = EndpointPool.from_config([{'endpoint': self.servers[0].endpoint, 'weight': 3},
+                                         {'endpoint': self.servers[1].endpoint, 'systems': ['http://loinc.*']}], cache=False)
+        rows = [self._validate(pool, self.SNOMED, '1') for _ in range(8)]
+        self.assertEqual(sum(r['server'] == self.servers[0].endpoint for r in rows), 6)
+        rows = [self._validate(pool, self.LOINC, '1234-5') for _ in range(4)]
+        self.assertEqual({r['server'] for r in rows}, {self.servers[1].endpoint})
+        self.assertTrue(all(r['result'] == 'PASS' for r in rows))
+
+    def test_failover(self):
+        """
+            Requests fail over when a server goes down, and it is marked unhealthy
+        """
+        pool = EndpointPool.from_config([{'endpoint': s.endpoint} for s in self.servers], cache=False)
+        self.servers[1].close()
+        rows = [self._validate(pool, self.SNOMED, '1') for _ in range(6)]
+        self.assertTrue(all(r['result'] == 'PASS' and r['server'] == self.servers[0].endpoint for r in rows))
+        stats = pool.stats()
+        self.assertFalse(stats[1]['healthy'])
+        self.assertEqual(stats[1]['failures'], 3)
+
+
+class TestWatch(unittest.TestCase):
+    SNOMED = 'http://snomed.info/sct'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.jdir = os.path.join(self.tmpdir, 'data')
+        os.makedirs(self.jdir)
+        self.outdir = os.path.join(self.tmpdir, 'out')
+        os.makedirs(self.outdir)
+        self.server = FakeTxServer(codesystems={self.SNOMED: {'1': 'One', '2': 'Two'}})
+        for name, code in (('a.json', '1'), ('b.json', '1')):
+            self._write(name, code)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, code):
+        resource = {'resourceType': 'Observation', 'id': name, 'code': {'coding': [{'system': self.SNOMED, 'code': code}]}}
+        with open(os.path.join(self.jdir, name), 'w') as f:
+            json.dump(resource, f)
+
+    def test_watch_revalidates_changed_file(self):
+        """
+            Only the edited file is re-validated, from a warm cache, and the report is rewritten in under a second
+        """
+        pool = EndpointPool.from_config(self.server.endpoint)
+        checks = TerminologyChecks(pool, os.path.join(os.getcwd(), 'config.json'))
+        watcher = threading.Thread(target=watch_terminology_check, args=(checks, self.jdir, self.outdir),
+                                   kwargs={'interval': 0.05, 'use_notify': False, 'max_updates': 1})
+        watcher.start()
+        time.sleep(0.3)
+        sent = len(self.server.requests)
+        self.assertEqual(sent, 1)   # both files share one cached code
+        edited = time.perf_counter()
+        self._write('b.json', '3')
+        watcher.join(timeout=5)
+        self.assertFalse(watcher.is_alive())
+        self.assertLess(time.perf_counter() - edited, 1.0)
+        self.assertEqual(len(self.server.requests), sent + 1)
+        with open(os.path.join(self.outdir, 'TestDataValidationReport.html')) as f:
+            html = f.read()
+        self.assertIn('FAIL', html)
+        self.assertIn('a.json', html)
+
+    def test_rule_hits_follow_edits_and_deletes(self):
+        """
+            The exclusion rule hits stay equal to the IGNORED rows as files are edited and deleted
+        """
+        def write_ignored(name, count):
+            codings = [{'system': 'http://example.org/cs', 'code': str(i)} for i in range(count)]
+            with open(os.path.join(self.jdir, name), 'w') as f:
+                json.dump({'resourceType': 'Observation', 'id': name, 'code': {'coding': codings}}, f)
+
+        write_ignored('c.json', 1)
+        write_ignored('d.json', 2)
+        checks = TerminologyChecks(EndpointPool.from_config(self.server.endpoint), os.path.join(os.getcwd(), 'config.json'))
+        watcher = threading.Thread(target=watch_terminology_check, args=(checks, self.jdir, self.outdir),
+                                   kwargs={'interval': 0.05, 'use_notify': False, 'max_updates': 2})
+        watcher.start()
+        time.sleep(0.3)
+        self.assertEqual(checks.rules_dataframe()['hits'].sum(), 3)
+        write_ignored('c.json', 4)
+        time.sleep(0.3)
+        self.assertEqual(checks.rules_dataframe()['hits'].sum(), 6)
+        os.remove(os.path.join(self.jdir, 'd.json'))
+        watcher.join(timeout=5)
+        self.assertFalse(watcher.is_alive())
+        self.assertEqual(checks.rules_dataframe()['hits'].sum(), 4)
+
+
+class TestService(unittest.TestCase):
+    SNOMED = 'http://snomed.info/sct'
+
+    def setUp(self):
+        self.server = FakeTxServer(codesystems={self.SNOMED: {'1': 'One', '2': 'Two'}})
+        pool = EndpointPool.from_config(self.server.endpoint)
+        checks = TerminologyChecks(pool, os.path.join(os.getcwd(), 'config.json'))
+        self.service = ValidationService(checks, port=0)
+        self.thread = threading.Thread(target=self.service.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.service.shutdown()
+        self.service.server_close()
+        self.server.close()
+
+    def _observation(self, id, code):
+        return {'resourceType': 'Observation', 'id': id, 'code': {'coding': [{'system': self.SNOMED, 'code': code}]}}
+
+    def _post(self, body, content_type='application/fhir+json', query=''):
+        request = urllib.request.Request(f"{self.service.url}/validate{query}", data=body.encode(),
+                                         headers={'Content-Type': content_type})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.load(response)
+
+    def test_validate_resource_bundle_and_ndjson(self):
+        """
+            A resource, a Bundle and NDJSON all return result rows; repeated codes come from the shared cache
+        """
+        reply = self._post(json.dumps(self._observation('o1', '1')), query='?name=obs.json')
+        self.assertEqual([(r['file'], r['resource_id'], r['result']) for r in reply['results']], [('obs.json', 'o1', 'PASS')])
+        bundle = {'resourceType': 'Bundle', 'entry': [{'resource': self._observation('o2', '2')}, {'resource': self._observation('o3', '9')}]}
+        reply = self._post(json.dumps(bundle))
+        self.assertEqual([(r['resource_id'], r['result']) for r in reply['results']], [('o2', 'PASS'), ('o3', 'FAIL')])
+        ndjson = '\n'.join([json.dumps(self._observation('o4', '1')), '{not json', json.dumps(self._observation('o5', '2'))])
+        reply = self._post(ndjson, content_type='application/fhir+ndjson')
+        self.assertEqual([r['result'] for r in reply['results']], ['PASS', 'ERROR', 'PASS'])
+        self.assertEqual(reply['summary']['resources'], 3)
+        self.assertEqual(len(self.server.requests), 3)   # codes 1, 2 and 9 sent once each
+
+    def test_concurrent_requests_and_metrics(self):
+        """
+            Concurrent requests are all answered and counted in /metrics
+        """
+        body = json.dumps(self._observation('o1', '1'))
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            replies = list(pool.map(lambda _: self._post(body), range(16)))
+        self.assertTrue(all(reply['results'][0]['result'] == 'PASS' for reply in replies))
+        with urllib.request.urlopen(f"{self.service.url}/metrics", timeout=10) as response:
+            metrics = json.load(response)
+        self.assertEqual(metrics['requests'], 16)
+        self.assertEqual(metrics['resources'], 16)
+        self.assertIsNotNone(metrics['latency_ms']['p95'])
+        self.assertGreater(metrics['tx_cache']['hits'], 0)
+
+
+    def test_shared_state_across_request_threads(self):
+        """
+            Rule hits from concurrent requests all count, and each thread has its own server session
+        """
+        codings = [{'system': 'http://example.org/cs', 'code': str(i)} for i in range(50)]
+        body = json.dumps({'resourceType': 'Observation', 'id': 'o1', 'code': {'coding': codings}})
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            replies = list(pool.map(lambda _: self._post(body), range(16)))
+        self.assertTrue(all(reply['summary']['rows'] == 50 for reply in replies))
+        self.assertEqual(self.service.checks.rules_dataframe()['hits'].sum(), 16 * 50)
+        endpoint = self.service.checks.endpoint.endpoints[0]
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            sessions = list(pool.map(lambda _: (time.sleep(0.05), endpoint.session)[1], range(2)))
+        self.assertIsNot(sessions[0], sessions[1])
+        self.assertIs(endpoint.session, endpoint.session)
+
+
+class TestDiff(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, rows):
+        path = os.path.join(self.tmpdir, name)
+        write_results_csv([(f, [ResultRow(file=f, resource_id='r1', path='Observation.code.coding[0]', system='http://loinc.org',
+                                          code=code, result=result, reason=reason)]) for f, code, result, reason in rows], path)
+        return path
+
+    def _changes(self, diff_file):
+        with open(diff_file, newline='') as f:
+            reader = csv.reader(f)
+            self.assertEqual(next(reader), DIFF_HEADER)
+            return sorted((row[0], row[1], row[5]) for row in reader)
+
+    def test_diff_reports_only_changes(self):
+        """
+            New failures, fixed failures, changed reasons and removed failures are reported; unchanged rows are not
+        """
+        previous = self._write('previous.csv', [
+            ('a.json', '1', 'PASS', 'ok'), ('a.json', '2', 'FAIL', 'Unknown code'), ('b.json', '3', 'FAIL', 'Unknown code'),
+            ('c.json', '4', 'FAIL', 'Unknown code'), ('d.json', '5', 'FAIL', 'Unknown code')])
+        current = self._write('current.csv', [
+            ('a.json', '1', 'FAIL', 'Unknown code'), ('a.json', '2', 'PASS', 'ok'), ('b.json', '3', 'ERROR', 'Request timed out.'),
+            ('c.json', '4', 'FAIL', 'Unknown code'), ('e.json', '6', 'FAIL', 'Unknown code'), ('e.json', '7', 'PASS', 'ok')])
+        expected = [('CHANGED_REASON', 'b.json', '3'), ('FIXED', 'a.json', '2'), ('NEW_FAIL', 'a.json', '1'),
+                    ('NEW_FAIL', 'e.json', '6'), ('REMOVED', 'd.json', '5')]
+        in_memory = os.path.join(self.tmpdir, 'diff.csv')
+        counts = diff_runs(previous, current, in_memory)
+        self.assertEqual(self._changes(in_memory), expected)
+        self.assertEqual(counts, {'NEW_FAIL': 2, 'FIXED': 1, 'CHANGED_REASON': 1, 'REMOVED': 1})
+        self.assertEqual(diff_exit_status(counts), 1)
+        partitioned = os.path.join(self.tmpdir, 'diff-partitioned.csv')
+        self.assertEqual(diff_runs(previous, current, partitioned, partition_bytes=64), counts)
+        self.assertEqual(self._changes(partitioned), expected)
+        self.assertEqual(diff_exit_status(diff_runs(current, current, in_memory)), 0)
+
+    def _real_run(self, jdir, package, server, name):
+        outdir = os.path.join(self.tmpdir, name)
+        run_terminology_check(server.endpoint, os.path.join(os.getcwd(), 'config.json'), jdir, outdir, [package], check_display=True)
+        return next(os.path.join(outdir, f) for f in os.listdir(outdir) if f.startswith('TestDataValidationResults-'))
+
+    def test_real_run_against_itself(self):
+        """
+            A real run diffed against itself, or against a rerun, has no changes, although several of its
+            rows share (file, resource_id, path, system, code): same-named files in two folders, a display
+            without a code, and one path bound by two profiles
+        """
+        snomed = 'http://snomed.info/sct'
+        package = os.path.join(self.tmpdir, 'npm', 'node_modules', 'example.pkg')
+        os.makedirs(package)
+        for name, vs in (('a', 'http://example.org/vs/small'), ('b', 'http://example.org/vs/other')):
+            with open(os.path.join(package, f'StructureDefinition-{name}.json'), 'w') as f:
+                json.dump({'resourceType': 'StructureDefinition', 'url': f'http://example.org/sd/{name}', 'snapshot': {'element': [
+                    {'id': 'Observation.code', 'path': 'Observation.code', 'binding': {'strength': 'required', 'valueSet': vs}}]}}, f)
+        server = FakeTxServer(valuesets={'http://example.org/vs/small': [(snomed, '1')], 'http://example.org/vs/other': [(snomed, '2')]},
+                              codesystems={snomed: {'1': 'One', '2': 'Two'}},
+                              designations={(snomed, '1'): ['One'], (snomed, '2'): ['Two']})
+        self.addCleanup(server.close)
+        jdir = os.path.join(self.tmpdir, 'data')
+        instances = {
+            'a/obs.json': {'resourceType': 'Observation', 'id': 'o1', 'meta': {'profile': ['http://example.org/sd/a', 'http://example.org/sd/b']},
+                           'code': {'coding': [{'system': snomed, 'code': '1', 'display': 'Uno'}]}},
+            'b/obs.json': {'resourceType': 'Observation', 'id': 'o1', 'code': {'coding': [{'system': snomed, 'code': '9'}]}},
+            'c/display-only.json': {'resourceType': 'Observation', 'id': 'o3', 'code': {'coding': [{'display': 'Something'}]}},
+        }
+        for relpath, resource in instances.items():
+            os.makedirs(os.path.dirname(os.path.join(jdir, relpath)), exist_ok=True)
+            with open(os.path.join(jdir, relpath), 'w') as f:
+                json.dump(resource, f)
+
+        first = self._real_run(jdir, package, server, 'run1')
+        with open(first, newline='') as f:
+            keys = [(r['file'], r['resource_id'], r['path'], r['system'], r['code']) for r in csv.DictReader(f)]
+        self.assertLess(len(set(keys)), len(keys))   # the old join key was not unique
+        diff_file = os.path.join(self.tmpdir, 'diff.csv')
+        counts = diff_runs(first, first, diff_file)
+        self.assertEqual(counts, {'NEW_FAIL': 0, 'FIXED': 0, 'CHANGED_REASON': 0, 'REMOVED': 0})
+        self.assertEqual(self._changes(diff_file), [])
+        second = self._real_run(jdir, package, server, 'run2')
+        self.assertEqual(diff_exit_status(diff_runs(first, second, diff_file, partition_bytes=64)), 0)
+        self.assertEqual(self._changes(diff_file), [])
+
+
+class TestDeduplication(unittest.TestCase):
+    SNOMED = 'http://snomed.info/sct'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = FakeTxServer(codesystems={self.SNOMED: {'1': 'One', '2': 'Two'}})
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, relpath, text):
+        path = os.path.join(self.tmpdir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_duplicates_validated_once(self):
+        """
+            Byte-identical and resource-identical copies reuse the first copy's rows under their own file names
+        """
+        resource = {'resourceType': 'Observation', 'id': 'o1', 'code': {'coding': [{'system': self.SNOMED, 'code': '1'}]}}
+        text = json.dumps(resource)
+        files = [self._write('a/obs.json', text), self._write('b/obs-copy.json', text),
+                 self._write('c/obs-pretty.json', json.dumps(resource, indent=2)),
+                 self._write('d/other.json', json.dumps(dict(resource, id='o2'))),
+                 self._write('e/bad.json', '{not json'), self._write('f/bad-copy.json', '{not json')]
+        checks = TerminologyChecks(self.server.endpoint, os.path.join(os.getcwd(), 'config.json'))
+        validated = []
+        original = checks.check_resource
+        checks.check_resource = lambda resource, name: validated.append(name) or original(resource, name)
+        results = dict(checks.check_files(files))
+        self.assertEqual(validated, [files[0], files[3]])
+        self.assertEqual(checks.dedup_stats, {'files': 6, 'unique': 3, 'byte_duplicates': 2, 'resource_duplicates': 1})
+        for path in files[:3]:
+            self.assertEqual([(r.file, r.resource_id, r.result) for r in results[path]], [(os.path.basename(path), 'o1', 'PASS')])
+        self.assertEqual([(r.file, r.result) for r in results[files[5]]], [('bad-copy.json', 'ERROR')])
+
+    def test_rule_hits_count_duplicates(self):
+        """
+            Excluded codings in reused rows are counted in the rule hits, matching the rows in the report
+        """
+        resource = {'resourceType': 'Observation', 'id': 'o1', 'code': {'coding': [{'system': 'http://example.org/cs', 'code': 'x'}]}}
+        files = [self._write(f'{d}/obs.json', json.dumps(resource)) for d in 'abc']
+        checks = TerminologyChecks(self.server.endpoint, os.path.join(os.getcwd(), 'config.json'))
+        rows = [row for _, file_rows in checks.check_files(files) for row in file_rows]
+        ignored = sum(row.result == 'IGNORED' for row in rows)
+        self.assertEqual(ignored, 3)
+        self.assertEqual(checks.rules_dataframe()['hits'].sum(), ignored)
+        self.assertEqual(len(self.server.requests), 0)
+
+
+@unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow is not installed")
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _rows(self, failures):
+        rows = [ResultRow(file='a.json', resource_id='r1', path='Observation.code', system='http://loinc.org', code='1',
+                          result='PASS', reason='ok', status_code=200)]
+        for system, n in failures.items():
+            rows.extend(ResultRow(file='b.json', resource_id='r2', path='Observation.code', system=system, code=str(i),
+                                  result='FAIL', reason='Unknown code', status_code=200) for i in range(n))
+        return rows
+
+    def test_append_and_query_trend(self):
+        """
+            Runs are appended as partitions and failures per system are counted per run
+        """
+        import pyarrow.parquet as pq
+
+        store = os.path.join(self.tmpdir, 'store')
+        append_results(self._rows({'http://loinc.org': 2, 'http://snomed.info/sct': 1}), store, '20250101-120000', 'https://tx1/fhir')
+        append_results(self._rows({'http://loinc.org': 1}), store, '20250102-120000', 'https://tx1/fhir/')
+        append_results(self._rows({'http://loinc.org': 5}), store, '20250102-130000', 'https://tx2/fhir')
+        trend = failure_trend(store)
+        self.assertEqual(trend.values.tolist(), [['20250101-120000', 'http://loinc.org', 2], ['20250101-120000', 'http://snomed.info/sct', 1],
+                                                 ['20250102-120000', 'http://loinc.org', 1], ['20250102-130000', 'http://loinc.org', 5]])
+        self.assertEqual(failure_trend(store, since='20250102', endpoint='https://tx1/fhir').values.tolist(),
+                         [['20250102-120000', 'http://loinc.org', 1]])
+        self.assertEqual(failure_trend(store, by='file', results=['PASS'])['count'].tolist(), [1, 1, 1])
+        pool = EndpointPool.from_config([{'endpoint': 'https://down/fhir'}, {'endpoint': 'https://tx1/fhir'}, {'endpoint': 'https://tx3/fhir'}])
+        pool.endpoints[0].healthy = False   # failed its capability check
+        append_results(self._rows({'http://snomed.info/sct': 1}), store, '20250103-120000', pool)
+        self.assertEqual(failure_trend(store, since='20250103', endpoint='https://tx1/fhir').values.tolist(),
+                         [['20250103-120000', 'http://snomed.info/sct', 1]])
+        part = next(os.path.join(d, f) for d, _, files in os.walk(store) for f in files if f.endswith('.parquet'))
+        self.assertTrue(str(pq.read_schema(part).field('system').type).startswith('dictionary'))
+
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = logging.getLogger()
+        self.saved = (self.root.level, list(self.root.handlers))
+
+    def tearDown(self):
+        self.root.setLevel(self.saved[0])
+        self.root.handlers[:] = self.saved[1]
+        shutil.rmtree(self.tmpdir)
+
+    def test_json_logs_written_in_background(self):
+        """
+            Records go through the queue to a JSON lines file; the level and sampling controls apply below WARNING
+        """
+        log_file = os.path.join(self.tmpdir, 'check.jsonl')
+        listener = setup_logging(log_file, 'DEBUG', json_format=True, sample_rate=0.25)
+        self.assertTrue(any(isinstance(h, DeferredQueueHandler) for h in self.root.handlers))
+        log = logging.getLogger('tester')
+        for i in range(8):
+            log.debug("Validation result for %s|%s", 'http://loinc.org', i)
+        log.warning("Failing over from %s: %s", 'https://tx1/fhir', {'status': 503})
+        listener.stop()
+        with open(log_file) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual([e['level'] for e in entries], ['DEBUG', 'DEBUG', 'WARNING'])
+        self.assertEqual(entries[0]['message'], 'Validation result for http://loinc.org|3')
+        self.assertEqual(entries[-1]['message'], "Failing over from https://tx1/fhir: {'status': 503}")
+        self.assertEqual(entries[-1]['logger'], 'tester')
+
+    def test_sampling_filter_keeps_fraction(self):
+        """
+            The sampling filter keeps an even share of DEBUG/INFO records and every warning
+        """
+        sampler = SamplingFilter(0.1)
+        info = logging.LogRecord('t', logging.INFO, __file__, 1, 'x', None, None)
+        error = logging.LogRecord('t', logging.ERROR, __file__, 1, 'x', None, None)
+        self.assertEqual(sum(sampler.filter(info) for _ in range(1000)), 100)
+        self.assertTrue(all(sampler.filter(error) for _ in range(10)))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,19 +1,30 @@
 import os
 import re
-import requests
 from datetime import datetime
 from os.path import isfile
 import json
 import glob
-import pandas as pd
-from urllib.parse import quote
-from fhirpathpy import evaluate
+import hashlib
 from utils import get_config, split_node_path
+from results import ResultRow, results_to_dataframe
+from rules import compile_rules
+from bindings import load_bindings, check_bindings, ValueSetCache
+from display import check_displays, DesignationCache
+from txindex import ensure_index
+from elements import load_element_schema, BACKBONE, LEAF, RESOURCE
+from txpool import EndpointPool, tx_get
+from txresponse import parse_validate_code_response
+from diff import write_results_csv, diff_runs, diff_exit_status, print_diff_summary
+from store import append_results
 import logging
 
+# requests and pandas are imported inside the functions that use them so that
+# `main.py -h` and a failed capability check don't pay their import cost.
+
 logger = logging.getLogger(__name__)
 SKIP_DIRS = ["assets", "temp", "templates"]
 EXTS = ["json"]
+CAPABILITY_TIMEOUT = 15   # seconds, as for the validation requests
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +56,7 @@ def get_json_files(root,filter=None):
             yield item
 
 
-def _extract_and_validate_elements(element, file_path, endpoint, cs_excluded, resource_id, current_path, current_file_results, parent_is_codeable_concept=False, cc_text=None):
+def _extract_and_validate_elements(element, file_path, endpoint, cs_excluded, resource_id, current_path, current_file_results, parent_is_codeable_concept=False, cc_text=None, tx_index=None):
     """
     Recursively extracts and validates coded elements from a FHIR resource fragment.
     """
@@ -61,48 +72,39 @@ def _extract_and_validate_elements(element, file_path, endpoint, cs_excluded, re
             # Use cc_text passed down if the parent was a CodeableConcept
             context_text = cc_text if parent_is_codeable_concept else None
             # Validate and get the result dictionary
-            test_result = validate_example_code(file_path, endpoint, cs_excluded, system, code, display, context_text, resource_id, current_path)
+            test_result = validate_example_code(file_path, endpoint, cs_excluded, system, code, display, context_text, resource_id, current_path, tx_index)
             # Append the single result dictionary to the list
             current_file_results.append(test_result)
             if display and not system and not code:
-                current_file_results.append({
-                    'file': split_node_path(file_path),
-                    'resource_id': resource_id,
-                    'path': current_path,
-                    'code': None,
-                    'display_provided': display,
-                    'text_context': cc_text,
-                    'system': None,
-                    'result': 'ERROR',
-                    'reason': 'Display provided but code and system are missing.',
-                    'status_code': None
-                })           
+                current_file_results.append(ResultRow(
+                    file=split_node_path(file_path),
+                    resource_id=resource_id,
+                    path=current_path,
+                    display_provided=display,
+                    text_context=cc_text,
+                    result='ERROR',
+                    reason='Display provided but code and system are missing.'
+                ))           
             elif display and not system:
-                current_file_results.append({
-                    'file': split_node_path(file_path),
-                    'resource_id': resource_id,
-                    'path': current_path,
-                    'code': None,
-                    'display_provided': display,
-                    'text_context': cc_text,
-                    'system': None,
-                    'result': 'ERROR',
-                    'reason': 'Display provided but system is missing.',
-                    'status_code': None
-                })  
+                current_file_results.append(ResultRow(
+                    file=split_node_path(file_path),
+                    resource_id=resource_id,
+                    path=current_path,
+                    display_provided=display,
+                    text_context=cc_text,
+                    result='ERROR',
+                    reason='Display provided but system is missing.'
+                ))  
             elif display and not code:
-                current_file_results.append({
-                    'file': split_node_path(file_path),
-                    'resource_id': resource_id,
-                    'path': current_path,
-                    'code': None,
-                    'display_provided': display,
-                    'text_context': cc_text,
-                    'system': None,
-                    'result': 'ERROR',
-                    'reason': 'Display provided but code is missing.',
-                    'status_code': None
-                })  
+                current_file_results.append(ResultRow(
+                    file=split_node_path(file_path),
+                    resource_id=resource_id,
+                    path=current_path,
+                    display_provided=display,
+                    text_context=cc_text,
+                    result='ERROR',
+                    reason='Display provided but code is missing.'
+                ))  
         # Check for CodeableConcept structure AFTER checking for Coding
         # A CodeableConcept might contain other nested elements to recurse into.
         is_codeable_concept = 'coding' in element and isinstance(element['coding'], list)
@@ -113,18 +115,14 @@ def _extract_and_validate_elements(element, file_path, endpoint, cs_excluded, re
         # We primarily rely on finding Coding elements inside the 'coding' array.
         # Let's add a check for CCs that might *only* have text.
         if not is_coding and element.get('text') and 'coding' in element and not element['coding']:
-                current_file_results.append({
-                'file': split_node_path(file_path),
-                'resource_id': resource_id,
-                'path': current_path,
-                'code': None,
-                'display_provided': None,
-                'text_context': element.get('text'),
-                'system': None,
-                'result': 'INFO',
-                'reason': 'CodeableConcept with text only, no codings.',
-                'status_code': None
-            })
+                current_file_results.append(ResultRow(
+                    file=split_node_path(file_path),
+                    resource_id=resource_id,
+                    path=current_path,
+                    text_context=element.get('text'),
+                    result='INFO',
+                    reason='CodeableConcept with text only, no codings.'
+                ))
 
 
         # Recurse through dictionary values
@@ -135,135 +133,200 @@ def _extract_and_validate_elements(element, file_path, endpoint, cs_excluded, re
                 for i, item in enumerate(value): # item should be a Coding dictionary
                     item_path = f"{new_path}[{i}]"
                     # Pass the CC's text down; the item itself is a Coding, so parent_is_cc is True
-                    _extract_and_validate_elements(item, file_path, endpoint, cs_excluded, resource_id, item_path, current_file_results, parent_is_codeable_concept=True, cc_text=current_concept_text_for_children)
+                    _extract_and_validate_elements(item, file_path, endpoint, cs_excluded, resource_id, item_path, current_file_results, parent_is_codeable_concept=True, cc_text=current_concept_text_for_children, tx_index=tx_index)
             elif isinstance(value, (dict, list)): # Only recurse into dicts or lists
                     # Pass current_concept_text_for_children only if the CURRENT element (element) is a CC
-                    _extract_and_validate_elements(value, file_path, endpoint, cs_excluded, resource_id, new_path, current_file_results, parent_is_codeable_concept=is_codeable_concept, cc_text=current_concept_text_for_children if is_codeable_concept else None)
+                    _extract_and_validate_elements(value, file_path, endpoint, cs_excluded, resource_id, new_path, current_file_results, parent_is_codeable_concept=is_codeable_concept, cc_text=current_concept_text_for_children if is_codeable_concept else None, tx_index=tx_index)
 
     elif isinstance(element, list):
         # Recurse through list items
         for i, item in enumerate(element):
             item_path = f"{current_path}[{i}]"
             # Carry forward parent_is_codeable_concept status and cc_text from the element containing the list
-            _extract_and_validate_elements(item, file_path, endpoint, cs_excluded, resource_id, item_path, current_file_results, parent_is_codeable_concept=parent_is_codeable_concept, cc_text=cc_text)
+            _extract_and_validate_elements(item, file_path, endpoint, cs_excluded, resource_id, item_path, current_file_results, parent_is_codeable_concept=parent_is_codeable_concept, cc_text=cc_text, tx_index=tx_index)
+
 
+EXTENSION_KEYS = ('extension', 'modifierExtension')
 
-def parse_validate_code_response(response_json):
+
+def _extract_extensions(element, file_path, endpoint, cs_excluded, resource_id, current_path, current_file_results, tx_index=None):
+    """
+    Walks an element that can't hold a CodeableConcept itself, extracting only from its extensions.
     """
-    Parses the JSON response (FHIR Parameters) from a $validate-code operation.
+    if isinstance(element, dict):
+        for key, value in element.items():
+            if isinstance(value, (dict, list)):
+                new_path = f"{current_path}.{key}"
+                if key in EXTENSION_KEYS or key.startswith('_'):
+                    _extract_and_validate_elements(value, file_path, endpoint, cs_excluded, resource_id, new_path, current_file_results, tx_index=tx_index)
+                else:
+                    _extract_extensions(value, file_path, endpoint, cs_excluded, resource_id, new_path, current_file_results, tx_index)
+    elif isinstance(element, list):
+        for i, item in enumerate(element):
+            _extract_extensions(item, file_path, endpoint, cs_excluded, resource_id, f"{current_path}[{i}]", current_file_results, tx_index)
 
-    Args:
-        response_json (dict): The parsed JSON response.
 
-    Returns:
-        tuple: (is_valid, display, message)
-               is_valid (bool or None): True if valid, False if invalid, None if result not found.
-               display (str or None): The canonical display from the server, or None.
-               message (str or None): The message from the server, or None.
+def _extract_resource(resource, element_schema, file_path, endpoint, cs_excluded, resource_id, current_path, current_file_results, tx_index=None):
+    """
+    Extracts from a whole resource, guided by its schema when the packages define its type.
     """
-    is_valid = None
-    display = None
-    message = None
+    schema = element_schema.get(resource.get('resourceType')) if element_schema and isinstance(resource, dict) else None
+    if schema is None:
+        _extract_and_validate_elements(resource, file_path, endpoint, cs_excluded, resource_id, current_path, current_file_results, tx_index=tx_index)
+    else:
+        _extract_guided(resource, element_schema, schema, schema.resource_type, file_path, endpoint, cs_excluded, resource_id, current_path, current_file_results, tx_index)
 
-    if not isinstance(response_json, dict) or response_json.get('resourceType') != 'Parameters':
-        return None, None, "Invalid response format: Not a Parameters resource."
 
-    parameters = response_json.get('parameter', [])
+def _extract_guided(element, element_schema, schema, schema_path, file_path, endpoint, cs_excluded, resource_id, current_path, current_file_results, tx_index=None):
+    """
+    Extracts and validates coded elements from a resource or backbone element, descending only
+    into the elements that the schema says can hold a CodeableConcept. Produces the same rows,
+    in the same order, as _extract_and_validate_elements.
+    """
+    if isinstance(element, list):
+        for i, item in enumerate(element):
+            _extract_guided(item, element_schema, schema, schema_path, file_path, endpoint, cs_excluded, resource_id, f"{current_path}[{i}]", current_file_results, tx_index)
+        return
+    if not isinstance(element, dict):
+        return
+
+    for key, value in element.items():
+        if not isinstance(value, (dict, list)):
+            continue
+        new_path = f"{current_path}.{key}"
+        child_path = f"{schema_path}.{key}"
+        child_path = schema.aliases.get(child_path, child_path)
+        kind = None if key in EXTENSION_KEYS or key.startswith('_') else schema.kind(child_path)
+        if kind == BACKBONE:
+            _extract_guided(value, element_schema, schema, child_path, file_path, endpoint, cs_excluded, resource_id, new_path, current_file_results, tx_index)
+        elif kind == LEAF:
+            _extract_extensions(value, file_path, endpoint, cs_excluded, resource_id, new_path, current_file_results, tx_index)
+        elif kind == RESOURCE:
+            items = value if isinstance(value, list) else [value]
+            for i, item in enumerate(items):
+                item_path = f"{new_path}[{i}]" if isinstance(value, list) else new_path
+                _extract_resource(item, element_schema, file_path, endpoint, cs_excluded, resource_id, item_path, current_file_results, tx_index)
+        else:
+            # CodeableConcepts, datatypes that can hold one, extensions and unknown elements
+            _extract_and_validate_elements(value, file_path, endpoint, cs_excluded, resource_id, new_path, current_file_results, tx_index=tx_index)
 
-    for param in parameters:
-        if isinstance(param, dict):
-            name = param.get('name')
-            if name == 'result':
-                is_valid = param.get('valueBoolean') # Should be True or False
-            elif name == 'display':
-                display = param.get('valueString')
-            elif name == 'message':
-                message = param.get('valueString')
 
-    return is_valid, display, message
+def _apply_validate_code_result(test_result, parsed, display_provided):
+    """
+    Set the result and reason of a row from a parsed $validate-code response.
+    """
+    is_valid, server_display, message = parsed
+    if is_valid is True:
+        test_result['result'] = 'PASS'
+        test_result['reason'] = message or "Code is valid."
+         # Optional: Check if provided display matches server display
+        if display_provided and server_display and display_provided != server_display:
+             test_result['reason'] += f" Provided display ('{display_provided}') differs from server display ('{server_display}')."
+        elif display_provided and not server_display:
+             test_result['reason'] += f" Server did not return a display for comparison with provided display ('{display_provided}')."
+
+    elif is_valid is False:
+        test_result['result'] = 'FAIL'
+        test_result['reason'] = message or "Code is not valid according to the terminology server."
+    else: # Result parameter was missing or not boolean
+        test_result['result'] = 'ERROR'
+        test_result['reason'] = message or "Validation response missing 'result' parameter or it was not boolean."
 
 
-def validate_example_code(file_path, endpoint, cs_excluded, system, code, display_provided, code_text, resource_id, current_path):
+def validate_example_code(file_path, endpoint, cs_excluded, system, code, display_provided, code_text, resource_id, current_path, tx_index=None):
     """
     Validates a code from an example resource instance against a FHIR terminology server.
 
     Args:
         file_path (str): Path to the source file.
-        endpoint (str): Base URL of the FHIR terminology server.
-        cs_excluded (list): List of excluded code system config dicts.
+        endpoint (str or EndpointPool): Base URL of the FHIR terminology server, or a pool of servers.
+        cs_excluded (ExclusionRules or list): Compiled exclusion rules, or the raw codesystem-excluded config list.
         system (str): The code system URI.
         code (str): The code value.
         display_provided (str): The display text provided in the instance.
         code_text (str): The text from the parent CodeableConcept (if applicable).
         resource_id (str): ID of the resource instance.
         current_path (str): JSON path to the element.
+        tx_index (TerminologyIndex): Index of the IG package CodeSystems; codes it can decide are not sent to the server.
 
     Returns:
-        dict: A dictionary containing the validation result.
+        ResultRow: The validation result.
     """
+    import requests
+
     base_file_name = split_node_path(file_path)
-    test_result = {
-        'file': base_file_name,
-        'resource_id': resource_id,
-        'path': current_path,
-        'code': code,
-        'display_provided': display_provided, # Keep the original display
-        'text_context': code_text, # Text from parent CC
-        'system': system,
-        'result': 'UNKNOWN', # Default status
-        'reason': '',
-        'status_code': None
-    }
-
-    # 1. Check if system is excluded
-    for exc in cs_excluded:
-        if isinstance(exc, dict) and exc.get("uri") == system:
-            test_result['result'] = exc.get('result', 'EXCLUDED') # Use configured result or default
-            test_result['reason'] = exc.get('reason', 'Code system is excluded from validation.')
-            logger.debug(f"Code system '{system}' excluded for code '{code}' in {base_file_name} at {current_path}.")
-            return test_result # Stop validation if excluded
+    test_result = ResultRow(
+        file=base_file_name,
+        resource_id=resource_id,
+        path=current_path,
+        code=code,
+        display_provided=display_provided, # Keep the original display
+        text_context=code_text, # Text from parent CC
+        system=system,
+        result='UNKNOWN', # Default status
+        reason=''
+    )
+
+    # 1. Check if system, code or path is excluded
+    rule = compile_rules(cs_excluded).match(system, code, current_path)
+    if rule is not None:
+        test_result['result'] = rule.result # Use configured result or default
+        test_result['reason'] = rule.reason
+        logger.debug("Code system '%s' excluded for code '%s' in %s at %s.", system, code, base_file_name, current_path)
+        return test_result # Stop validation if excluded
 
     # 2. Check for missing code when display is provided
     if display_provided and not code:
         test_result['result'] = 'ERROR'
         test_result['reason'] = "Display provided but code is missing."
-        logger.error(f"Display provided but code is missing in {base_file_name} at {current_path}.")
+        logger.error("Display provided but code is missing in %s at %s.", base_file_name, current_path)
         return test_result
     
-    # 3. Prepare and send request
-    if not endpoint.endswith('/'):
-        endpoint += '/'
+    # 3. Answer locally when the code's CodeSystem is in the IG package terminology index
+    #    (a missing code is left to the checks above and the server)
+    if tx_index is not None and code:
+        known = tx_index.code_status(system, code)
+        if known is not None:
+            is_valid, index_display = known
+            if is_valid:
+                test_result['result'] = 'PASS'
+                test_result['reason'] = "Code is valid (IG package CodeSystem)."
+                if display_provided and index_display and display_provided != index_display:
+                    test_result['reason'] += f" Provided display ('{display_provided}') differs from CodeSystem display ('{index_display}')."
+            else:
+                test_result['result'] = 'FAIL'
+                test_result['reason'] = f"Code '{code}' is not in the IG package CodeSystem {system}."
+            return test_result
+
+    # 4. Prepare and send request
     # Use parameters for requests library to handle encoding
     params = {'url': system, 'code': code}
     # Optionally add display for validation if server supports it well via GET
     # params['display'] = display_provided # Uncomment if you want to validate display this way
-    query_url = f'{endpoint}CodeSystem/$validate-code'
-    headers = {'Accept': 'application/fhir+json', 'User-Agent': 'FHIR-Terminology-Validator-Client/1.0'} # Good practice to add User-Agent
+
+    # The pool caches parsed results of earlier successful calls for the same code
+    cache_key = ('CodeSystem/$validate-code', system, code)
+    hit = endpoint.cached(cache_key) if isinstance(endpoint, EndpointPool) else None
+    if hit is not None:
+        parsed, test_result['server'] = hit
+        test_result['status_code'] = 200
+        _apply_validate_code_result(test_result, parsed, display_provided)
+        logger.debug("Validation result for %s|%s at %s: %s - %s (cached)", system, code, current_path, test_result['result'], test_result['reason'])
+        return test_result
 
     try:
-        response = requests.get(query_url, headers=headers, params=params, timeout=15) # Added timeout
+        # tx_get balances and fails over when endpoint is an EndpointPool
+        response, test_result['server'] = tx_get(endpoint, 'CodeSystem/$validate-code', params, system, timeout=15)
         test_result['status_code'] = response.status_code
         response.raise_for_status() # Raises HTTPError for 4xx/5xx responses
 
-        # 3. Process successful response (200 OK)
+        # 4. Process successful response (200 OK)
         data = response.json()
-        is_valid, server_display, message = parse_validate_code_response(data)
-
-        if is_valid is True:
-            test_result['result'] = 'PASS'
-            test_result['reason'] = message or "Code is valid."
-             # Optional: Check if provided display matches server display
-            if display_provided and server_display and display_provided != server_display:
-                 test_result['reason'] += f" Provided display ('{display_provided}') differs from server display ('{server_display}')."
-            elif display_provided and not server_display:
-                 test_result['reason'] += f" Server did not return a display for comparison with provided display ('{display_provided}')."
-
-        elif is_valid is False:
-            test_result['result'] = 'FAIL'
-            test_result['reason'] = message or "Code is not valid according to the terminology server."
-        else: # Result parameter was missing or not boolean
-            test_result['result'] = 'ERROR'
-            test_result['reason'] = message or "Validation response missing 'result' parameter or it was not boolean."
+        parsed = parse_validate_code_response(data)
+        if response.status_code == 200 and parsed[0] is not None and isinstance(endpoint, EndpointPool):
+            # Only definite answers are cached; errors and rate limits are asked again next time
+            endpoint.store(cache_key, parsed, test_result['server'])
+        _apply_validate_code_result(test_result, parsed, display_provided)
 
     except requests.exceptions.HTTPError as e:
         test_result['result'] = 'ERROR' # Changed from FAIL for HTTP errors
@@ -289,45 +352,82 @@ def validate_example_code(file_path, endpoint, cs_excluded, system, code, displa
          test_result['result'] = 'ERROR'
          test_result['reason'] = "Invalid JSON response from server."
     except Exception as e: # Catch unexpected errors during processing
-        logger.error(f"Unexpected error during validation for {system}|{code}: {e}", exc_info=True)
+        logger.error("Unexpected error during validation for %s|%s: %s", system, code, e, exc_info=True)
         test_result['result'] = 'ERROR'
         test_result['reason'] = f"Unexpected validation error: {e}"
 
 
-    logger.debug(f"Validation result for {system}|{code} at {current_path}: {test_result['result']} - {test_result['reason']}")
+    logger.debug("Validation result for %s|%s at %s: %s - %s", system, code, current_path, test_result['result'], test_result['reason'])
     return test_result
 
 ##
 ## search_json_file: search a json file for FHIR coding elements
 ##
 
-def search_json_file(endpoint, cs_excluded, file):
+def search_resource(endpoint, cs_excluded, resource, file, binding_index=None, vs_cache=None, designation_cache=None, tx_index=None, element_schema=None):
+    """
+    Extract and validate the coded elements of an already parsed resource.
+    `file` is the name the results are reported against.
+    """
+    cs_excluded = compile_rules(cs_excluded)
     file_results = []
+    resource_id = resource.get('id', 'UnknownID')
+    resource_type = resource.get('resourceType', 'UnknownType')
+    if element_schema:
+        # Only descend into the elements that can hold codes for this resource type
+        _extract_resource(resource, element_schema, file, endpoint, cs_excluded, resource_id, resource_type, file_results, tx_index)
+    else:
+        _extract_and_validate_elements(resource, file, endpoint, cs_excluded, resource_id, resource_type, file_results, parent_is_codeable_concept=False, cc_text=None, tx_index=tx_index)
+
+    # Check displays and bindings of the codings found above
+    extra_results = []
+    if designation_cache is not None:
+        extra_results.extend(check_displays(file_results, designation_cache))
+    if binding_index and vs_cache is not None:
+        extra_results.extend(check_bindings(resource, file_results, binding_index, vs_cache, cs_excluded))
+    file_results.extend(extra_results)
+
+    return file_results
+
+
+def search_json_file(endpoint, cs_excluded, file, binding_index=None, vs_cache=None, designation_cache=None, tx_index=None, element_schema=None):
     with open(file, 'r') as f:
         resource = json.load(f)
-        resource_id = resource.get('id', 'UnknownID')
-        resource_type = resource.get('resourceType', 'UnknownType')
-        _extract_and_validate_elements(resource, file, endpoint, cs_excluded, resource_id, resource_type, file_results, parent_is_codeable_concept=False, cc_text=None)
+    return search_resource(endpoint, cs_excluded, resource, file, binding_index, vs_cache, designation_cache, tx_index, element_schema)
 
-    return file_results
+
+def is_terminology_capability(data):
+    """
+    Check a CapabilityStatement instantiates the R4 terminology-server capability.
+    Reads `instantiates` and `fhirVersion` directly rather than through fhirpath.
+    """
+    if not isinstance(data, dict):
+        return False
+    instantiates = data.get('instantiates')
+    server_type = instantiates[0] if isinstance(instantiates, list) and instantiates else None
+    return (server_type == "http://hl7.org/fhir/CapabilityStatement/terminology-server" and
+            data.get('fhirVersion') == "4.0.1")
 
 
-def run_capability_test(endpoint):
+def run_capability_test(endpoint, timeout=CAPABILITY_TIMEOUT):
     """
        Fetch the capability statement from the endpoint and assert it 
        instantiates http://hl7.org/fhir/CapabilityStatement/terminology-server
+       A server that doesn't answer within `timeout` seconds gets 408, so a hung
+       server is marked unhealthy instead of holding up startup.
     """
+    import requests
+
     query = f'{endpoint}/metadata'
     headers = {'Accept': 'application/fhir+json'}
-    response = requests.get(query, headers=headers)
+    try:
+        response = requests.get(query, headers=headers, timeout=timeout)
+    except requests.exceptions.Timeout:
+        logger.error("Capability test timed out after %ss for %s", timeout, endpoint)
+        return 408  # Request Timeout
     if response.status_code == 200:
         data = response.json()
-        server_type = evaluate(data, "instantiates[0]")
-        fhir_version = evaluate(data, "fhirVersion")
-        if (isinstance(server_type, list) and len(server_type) > 0 and 
-            server_type[0] == "http://hl7.org/fhir/CapabilityStatement/terminology-server" and 
-            isinstance(fhir_version, list) and len(fhir_version) > 0 and 
-            fhir_version[0] == "4.0.1"):
+        if is_terminology_capability(data):
             return 200  # OK
         else:
             return 418  # I'm a teapot (have we upgraded to a new version??)
@@ -335,103 +435,163 @@ def run_capability_test(endpoint):
         return response.status_code   # I'm most likely offline
 
 
-def run_terminology_check(endpoint, testconf, jdir, outdir):
+class TerminologyChecks:
     """
-    Tests that the IG example instance codes are valid against a terminology server,
-    reporting results in HTML and Excel files.
-
-    Args:
-        endpoint (str): Base URL of the FHIR terminology server.
-        testconf (any): Configuration source (e.g., dict, file path) for exclusions.
-        jdir (str): Directory containing FHIR JSON example instances.
-        outdir (str): Directory to save the report files.
-
-    Returns:
-        int: Exit status (0 for success/no fails, 1 if any fails occurred).
+    The per-run validation setup: exclusion rules, caches and package indexes. Built once
+    and reused for every file, so watch mode and the service keep their caches warm.
     """
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
-        logger.info(f"Created output directory: {outdir}")
-
-    now = datetime.now() # current date and time
-    ts = now.strftime("%Y%m%d-%H%M%S")
-    html_file = os.path.join(outdir, 'TestDataValidationReport.html')
-    excel_file = os.path.join(outdir, f'TestDataValidationReport-{ts}.xlsx')
 
-    cs_excluded = get_config(testconf, 'codesystem-excluded')
-    if cs_excluded is None:
-        logger.warning("Could not load 'codesystem-excluded' configuration. No systems will be excluded.")
-        cs_excluded = []
-
-    all_results = [] # Master list to hold all results from all files
-
-    logger.info(f"Starting terminology validation against: {endpoint}")
-    logger.info(f"Processing files in: {jdir}")
-    logger.info(f"Excluded systems: {cs_excluded if cs_excluded else 'None'}")
-
-    for instance_file in get_json_files(jdir):
-        logger.info(f"...processing instance: {split_node_path(instance_file)}")
+    def __init__(self, endpoint, testconf, package_paths=None, check_display=False):
+        self.endpoint = endpoint
+        cs_excluded = get_config(testconf, 'codesystem-excluded')
+        if cs_excluded is None:
+            logger.warning("Could not load 'codesystem-excluded' configuration. No systems will be excluded.")
+            cs_excluded = []
+        # Compile the exclusion rules once; invalid rules stop the run here rather than mid-way
+        self.cs_excluded = compile_rules(cs_excluded)
+
+        self.binding_index, self.vs_cache, self.tx_index, self.element_schema = None, None, None, None
+        if package_paths:
+            self.binding_index = load_bindings(package_paths)
+            self.element_schema = load_element_schema(package_paths)
+            self.tx_index = ensure_index(package_paths)
+            self.vs_cache = ValueSetCache(endpoint, tx_index=self.tx_index)
+        self.designation_cache = DesignationCache(endpoint) if check_display else None
+        self.dedup_stats = {'files': 0, 'unique': 0, 'byte_duplicates': 0, 'resource_duplicates': 0}
+
+    def check_file(self, instance_file):
+        """
+        Validate one instance file. File level problems become ERROR rows rather than exceptions.
+
+        Returns:
+            list: The ResultRows for the file.
+        """
         try:
             # search_json_file now returns results for *just this file*
-            file_results = search_json_file(endpoint, cs_excluded, instance_file)
-            if file_results: # Only extend if results were found
-                 all_results.extend(file_results)
+            return search_json_file(self.endpoint, self.cs_excluded, instance_file, self.binding_index, self.vs_cache,
+                                    self.designation_cache, self.tx_index, self.element_schema)
         except FileNotFoundError:
-            logger.error(f"File not found: {instance_file}. Skipping.")
+            logger.error("File not found: %s. Skipping.", instance_file)
         except json.JSONDecodeError:
-            logger.error(f"Invalid JSON in file: {instance_file}. Skipping.")
-            all_results.append({ # Add an error entry for reporting
-                'file': split_node_path(instance_file),
-                'resource_id': 'N/A',
-                'path': 'File Level',
-                'code': None, 'display': None, 'text': None, 'system': None,
-                'result': 'ERROR',
-                'reason': 'Invalid JSON format',
-                'status_code': None
-            })
+            logger.error("Invalid JSON in file: %s. Skipping.", instance_file)
+            return [ResultRow( # Add an error entry for reporting
+                file=split_node_path(instance_file),
+                resource_id='N/A',
+                path='File Level',
+                result='ERROR',
+                reason='Invalid JSON format'
+            )]
         except Exception as e:
-            logger.error(f"Unexpected error processing file {instance_file}: {e}", exc_info=True)
-            all_results.append({ # Add an error entry for reporting
-                'file': split_node_path(instance_file),
-                'resource_id': 'N/A',
-                'path': 'File Level',
-                'code': None, 'display': None, 'text': None, 'system': None,
-                'result': 'ERROR',
-                'reason': f'Unexpected error: {str(e)}',
-                'status_code': None
-            })
-
-
-    # --- Output Results ---
-    if not all_results:
-        logger.warning("No coded elements found or processed in any files.")
-        # Create empty files or just return? Let's create empty reports.
-        header = ['file', 'resource_id', 'path', 'code', 'display_provided', 'text_context', 'system', 'result', 'reason', 'status_code']
-        df_results = pd.DataFrame([], columns=header)
-        exit_status = 0 # No failures if no results
-    else:
-        # Define header based on keys returned by validate_example_code
-        # Ensure validate_example_code returns these consistently
-        header = ['file', 'resource_id', 'path', 'code', 'display_provided', 'text_context', 'system', 'result', 'reason', 'status_code']
-        df_results = pd.DataFrame(all_results)
-        # Ensure all expected columns exist, fill missing with None or appropriate default if necessary
-        for col in header:
-            if col not in df_results.columns:
-                df_results[col] = None
-        df_results = df_results[header] # Reorder columns to match header
-
-        # Determine exit status: 1 if any 'FAIL' exists, 0 otherwise
-        # Exclude ERROR results from causing a non-zero exit code unless desired
-        exit_status = 1 if (df_results['result'] == 'FAIL').any() else 0
-
-    logger.info(f"Validation complete. Total results: {len(df_results)}. Fails found: {(df_results['result'] == 'FAIL').sum()}.")
-
-    # Output as HTML
+            logger.error("Unexpected error processing file %s: %s", instance_file, e, exc_info=True)
+            return [ResultRow( # Add an error entry for reporting
+                file=split_node_path(instance_file),
+                resource_id='N/A',
+                path='File Level',
+                result='ERROR',
+                reason=f'Unexpected error: {str(e)}'
+            )]
+        return []
+
+    def check_resource(self, resource, name):
+        """
+        Validate a parsed resource, reporting its rows against `name`.
+        """
+        return search_resource(self.endpoint, self.cs_excluded, resource, name, self.binding_index, self.vs_cache,
+                               self.designation_cache, self.tx_index, self.element_schema)
+
+    def check_files(self, instance_files):
+        """
+        Validate instance files, checking each distinct resource only once. Files that are
+        byte-identical, or that parse to the same resource, reuse the first copy's results
+        with their own file name, and its exclusion rule hits are counted again so the rule
+        hit counts match the rows in the report. Counts are kept in self.dedup_stats.
+
+        Yields:
+            tuple: (instance_file, list of ResultRows)
+        """
+        stats = self.dedup_stats = dict.fromkeys(self.dedup_stats, 0)
+        content_keys = {}   # sha256 of the file bytes -> content key
+        checked = {}        # content key -> (ResultRows, exclusion rule hits) of the first copy
+        for instance_file in instance_files:
+            try:
+                with open(instance_file, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                logger.error("File not found: %s. Skipping.", instance_file)
+                continue
+            stats['files'] += 1
+            byte_key = hashlib.sha256(data).digest()
+            content_key = content_keys.get(byte_key)
+            if content_key is not None:
+                stats['byte_duplicates'] += 1
+            else:
+                try:
+                    resource = json.loads(data)
+                    # Key on the resource itself so formatting and key order don't matter
+                    canonical = json.dumps(resource, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+                    content_key = hashlib.sha256(canonical.encode('utf-8')).digest()
+                except ValueError:
+                    resource, content_key = None, byte_key
+                content_keys[byte_key] = content_key
+                if content_key in checked:
+                    stats['resource_duplicates'] += 1
+            first = checked.get(content_key)
+            if first is not None:
+                rows, rule_hits = first
+                self.cs_excluded.add_hits(rule_hits)
+                name = split_node_path(instance_file)
+                yield instance_file, [row.replace(file=name) for row in rows]
+                continue
+            stats['unique'] += 1
+            hits_before = self.cs_excluded.hit_counts()
+            if resource is None:
+                logger.error("Invalid JSON in file: %s. Skipping.", instance_file)
+                rows = self._file_error(instance_file, 'Invalid JSON format')
+            else:
+                try:
+                    rows = self.check_resource(resource, instance_file)
+                except Exception as e:
+                    logger.error("Unexpected error processing file %s: %s", instance_file, e, exc_info=True)
+                    rows = self._file_error(instance_file, f'Unexpected error: {str(e)}')
+            checked[content_key] = (rows, self.cs_excluded.hit_counts() - hits_before)
+            yield instance_file, rows
+
+    def _file_error(self, instance_file, reason):
+        return [ResultRow(file=split_node_path(instance_file), resource_id='N/A', path='File Level', result='ERROR', reason=reason)]
+
+    def rules_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.cs_excluded.summary(), columns=['rule', 'result', 'reason', 'hits'])
+
+    def log_stats(self):
+        if self.vs_cache is not None:
+            logger.info("ValueSet binding checks: %s", self.vs_cache.stats)
+        if self.designation_cache is not None:
+            logger.info("Display checks: %s", self.designation_cache.stats)
+        if isinstance(self.endpoint, EndpointPool):
+            logger.info("Validation cache: %s", self.endpoint.cache_stats())
+            for server_stats in self.endpoint.stats():
+                logger.info("Terminology server: %s", server_stats)
+        for row in self.cs_excluded.summary():
+            logger.info("Exclusion rule hits: %s for %s", row['hits'], row['rule'])
+
+
+def write_html_report(df_results, df_rules, html_file):
+    """
+    Write the HTML report, replacing the file in one step so a browser never sees half of it.
+    """
     html_content = df_results.to_html()
-    with open(html_file, "w") as fh:
+    html_content += "\n<h2>Exclusion rules</h2>\n" + df_rules.to_html(index=False)
+    tmp_file = f"{html_file}.tmp"
+    with open(tmp_file, "w") as fh:
         fh.write(html_content)
+    os.replace(tmp_file, html_file)
+
+
+def write_excel_report(df_results, df_rules, excel_file):
+    import pandas as pd
 
-    # Generate Excel output
     writer = pd.ExcelWriter(excel_file, engine='xlsxwriter')
     df_results.to_excel(writer, sheet_name='Terminology Checks', index=False)
     
@@ -457,8 +617,83 @@ def run_terminology_check(endpoint, testconf, jdir, outdir):
                                        'value': '"FAIL"',
                                        'format': workbook.add_format({'bg_color': '#FFC7CE'})})  # type: ignore
     
+    df_rules.to_excel(writer, sheet_name='Exclusion Rules', index=False)
+    writer.sheets['Exclusion Rules'].set_column('A:D', 40)
+
     writer.close()
-    
+
+
+def run_terminology_check(endpoint, testconf, jdir, outdir, package_paths=None, check_display=False, previous_results=None, store_dir=None):
+    """
+    Tests that the IG example instance codes are valid against a terminology server,
+    reporting results in HTML, Excel and csv files.
+
+    Args:
+        endpoint (str or EndpointPool): Base URL of the FHIR terminology server, or a pool of servers.
+        testconf (any): Configuration source (e.g., dict, file path) for exclusions.
+        jdir (str): Directory containing FHIR JSON example instances.
+        outdir (str): Directory to save the report files.
+        package_paths (list): npm package folders to read profile bindings from.
+                              ValueSet binding checks are skipped when not given.
+        check_display (bool): Check provided display text against the code's designations.
+        previous_results (str): Results csv of an earlier run. When given, the changes since
+                                that run are written to TestDataValidationDiff.csv.
+        store_dir (str): Parquet result store to append this run's results to (needs pyarrow).
+
+    Returns:
+        int: Exit status (0 for success/no fails, 1 if any fails occurred).
+             With previous_results, 1 only if there are new failures since that run.
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+        logger.info("Created output directory: %s", outdir)
+
+    now = datetime.now() # current date and time
+    ts = now.strftime("%Y%m%d-%H%M%S")
+    html_file = os.path.join(outdir, 'TestDataValidationReport.html')
+    excel_file = os.path.join(outdir, f'TestDataValidationReport-{ts}.xlsx')
+    csv_file = os.path.join(outdir, f'TestDataValidationResults-{ts}.csv')
+
+    checks = TerminologyChecks(endpoint, testconf, package_paths, check_display)
+
+    all_results = [] # Master list to hold all results from all files
+
+    logger.info("Starting terminology validation against: %s", endpoint)
+    logger.info("Processing files in: %s", jdir)
+    logger.info("Exclusion rules: %s", [rule.describe() for rule in checks.cs_excluded.rules] if len(checks.cs_excluded) else 'None')
+
+    sources = [] # (path relative to jdir, rows) per file, for the results csv
+    for instance_file, file_results in checks.check_files(get_json_files(jdir)):
+        logger.info("...processed instance: %s", split_node_path(instance_file))
+        all_results.extend(file_results)
+        sources.append((os.path.relpath(instance_file, jdir).replace(os.sep, "/"), file_results))
+    dedup = checks.dedup_stats
+    print(f"{dedup['files']} files, {dedup['unique']} unique resources validated; reused results for "
+          f"{dedup['byte_duplicates']} byte-identical and {dedup['resource_duplicates']} resource-identical duplicates")
+    logger.info("Duplicate files: %s", dedup)
+
+
+    # --- Output Results ---
+    # Rows stay as compact ResultRow objects until here; build the DataFrame once.
+    if not all_results:
+        logger.warning("No coded elements found or processed in any files.")
+    df_results = results_to_dataframe(all_results)
+
+    logger.info("Validation complete. Total results: %s. Fails found: %s.", len(df_results), (df_results['result'] == 'FAIL').sum())
+    checks.log_stats()
+
+    df_rules = checks.rules_dataframe()
+    write_html_report(df_results, df_rules, html_file)
+    write_excel_report(df_results, df_rules, excel_file)
+    write_results_csv(sources, csv_file)
+    if store_dir:
+        append_results(all_results, store_dir, ts, endpoint)
+
+    if previous_results:
+        diff_file = os.path.join(outdir, 'TestDataValidationDiff.csv')
+        counts = diff_runs(previous_results, csv_file, diff_file)
+        print_diff_summary(counts, diff_file)
+        return diff_exit_status(counts)
+
     exit_status = 1 if (df_results['result'] == 'FAIL').any() else 0
     return exit_status
-
@@ -0,0 +1,298 @@
+import os
+import json
+import glob
+import mmap
+import struct
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+##
+## Terminology index built from the CodeSystems and ValueSets in the IG packages
+##
+## The index is a single binary file that is memory-mapped, so opening it costs
+## next to nothing however many IGs are loaded. Layout (all integers little-endian u32):
+##
+##   header       magic, format version, package fingerprint and section counts
+##   offsets      n_strings + 1 offsets into the string pool
+##   pool         UTF-8 strings, sorted bytewise so a string's id is its rank
+##   systems      (system id, flags) sorted by id          flags: 1 = content complete
+##   codes        (system id, code id, display id) sorted
+##   valuesets    (valueset id, flags) sorted by id       flags: 1 = fully enumerated
+##   members      (valueset id, system id, code id) sorted
+##
+## Lookups binary search the string table for ids, then the record tables, so each
+## is O(log n). The index is rebuilt only when the installed package set changes.
+##
+
+MAGIC = b'FTXI'
+FORMAT_VERSION = 1
+NO_STRING = 0xFFFFFFFF
+COMPLETE = 1
+_HEADER = struct.Struct('<4sI32s6I')
+_U32 = struct.Struct('<I')
+_PAIR = struct.Struct('<II')
+_TRIPLE = struct.Struct('<III')
+
+
+def _installed_version(package_path):
+    """
+    name@version of the package installed at package_path, from its package.json (or the
+    .fetched-version marker written by getter.py), or None if nothing is installed there.
+    """
+    try:
+        with open(os.path.join(package_path, 'package.json')) as f:
+            manifest = json.load(f)
+        return f"{manifest['name']}@{manifest['version']}"
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    try:
+        with open(os.path.join(package_path, '.fetched-version')) as f:
+            return f"{os.path.basename(package_path)}@{f.read().strip()}"
+    except OSError:
+        return None
+
+
+def package_fingerprint(package_paths):
+    """
+    sha256 of the packages actually installed at package_paths, independent of order.
+    A path with no package installed (e.g. a failed download) is part of the fingerprint,
+    so the index is rebuilt once the package does arrive.
+    """
+    keys = sorted(_installed_version(path) or f"missing:{os.path.abspath(path)}" for path in package_paths or [])
+    return hashlib.sha256(json.dumps([FORMAT_VERSION] + keys).encode()).digest()
+
+
+def default_index_path(package_paths):
+    # Kept next to node_modules, so a clean package fetch also drops the index
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(package_paths[0]))), 'terminology.idx')
+
+
+def _concepts(concepts, found):
+    for concept in concepts or []:
+        if concept.get('code') is not None:
+            found.append((concept['code'], concept.get('display')))
+        _concepts(concept.get('concept'), found)
+
+
+def _valueset_members(vs):
+    """
+    The (system, code) members of a ValueSet when they can be listed without a server,
+    i.e. from a complete expansion or a compose made only of enumerated concepts.
+
+    Returns:
+        tuple: (members, complete)
+    """
+    expansion = vs.get('expansion') or {}
+    if expansion.get('contains'):
+        members = []
+        stack = list(expansion['contains'])
+        while stack:
+            entry = stack.pop()
+            if entry.get('code') is not None and not entry.get('abstract'):
+                members.append((entry.get('system'), entry['code']))
+            stack.extend(entry.get('contains') or [])
+        return members, expansion.get('total') in (None, len(members))
+
+    compose = vs.get('compose') or {}
+    members = []
+    complete = bool(compose.get('include')) and not compose.get('exclude')
+    for include in compose.get('include', []):
+        if include.get('filter') or include.get('valueSet') or not include.get('concept'):
+            complete = False
+            continue
+        members.extend((include.get('system'), concept['code']) for concept in include['concept'] if concept.get('code'))
+    return members, complete
+
+
+def build_index(package_paths, index_file, fingerprint):
+    """
+    Compile the CodeSystems and ValueSets in the packages into the index file.
+    """
+    codesystems = {}   # url -> (complete, [(code, display)])
+    valuesets = {}     # url -> (complete, [(system, code)])
+    for package_path in package_paths:
+        for resource_file in glob.glob(os.path.join(package_path, '*.json')):
+            try:
+                with open(resource_file) as f:
+                    resource = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning("Could not read package file %s: %s", resource_file, e)
+                continue
+            if not isinstance(resource, dict) or not resource.get('url'):
+                continue
+            if resource.get('resourceType') == 'CodeSystem':
+                concepts = []
+                _concepts(resource.get('concept'), concepts)
+                codesystems[resource['url']] = (resource.get('content') == 'complete', concepts)
+            elif resource.get('resourceType') == 'ValueSet':
+                members, complete = _valueset_members(resource)
+                valuesets[resource['url']] = (complete, members)
+
+    strings = set(codesystems) | set(valuesets)
+    for _, concepts in codesystems.values():
+        strings.update(code for code, _ in concepts)
+        strings.update(display for _, display in concepts if display)
+    for _, members in valuesets.values():
+        strings.update(value for member in members for value in member if value)
+    encoded = sorted(s.encode('utf-8') for s in strings)
+    ids = {s.decode('utf-8'): i for i, s in enumerate(encoded)}
+
+    systems = sorted((ids[url], COMPLETE if complete else 0) for url, (complete, _) in codesystems.items())
+    codes = sorted({(ids[url], ids[code], ids[display] if display else NO_STRING)
+                    for url, (_, concepts) in codesystems.items() for code, display in concepts})
+    vs_table = sorted((ids[url], COMPLETE if complete else 0) for url, (complete, _) in valuesets.items())
+    members = sorted({(ids[url], ids[system] if system else NO_STRING, ids[code])
+                      for url, (_, vs_members) in valuesets.items() for system, code in vs_members})
+
+    offsets = [0]
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    pool = b''.join(encoded)
+    pool += b'\0' * (-len(pool) % 4)
+
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, fingerprint, len(encoded), len(pool),
+                             len(systems), len(codes), len(vs_table), len(members)))
+        f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        f.write(pool)
+        for table, record in ((systems, _PAIR), (codes, _TRIPLE), (vs_table, _PAIR), (members, _TRIPLE)):
+            f.write(b''.join(record.pack(*row) for row in table))
+    os.replace(tmp_file, index_file)
+    logger.info("Built terminology index %s: %s CodeSystems, %s codes, %s ValueSets, %s ValueSet members",
+                index_file, len(systems), len(codes), len(vs_table), len(members))
+
+
+def read_fingerprint(index_file):
+    try:
+        with open(index_file, 'rb') as f:
+            magic, version, fingerprint, *_ = _HEADER.unpack(f.read(_HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return None
+    return fingerprint
+
+
+def ensure_index(package_paths, index_file=None):
+    """
+    Open the terminology index, building it first if it is missing or was built
+    from a different set of installed packages.
+
+    Returns:
+        TerminologyIndex
+    """
+    index_file = index_file or default_index_path(package_paths)
+    fingerprint = package_fingerprint(package_paths)
+    missing = [path for path in package_paths if _installed_version(path) is None]
+    if missing:
+        logger.warning("Terminology index does not include packages that are not installed: %s", missing)
+    if read_fingerprint(index_file) != fingerprint:
+        build_index(package_paths, index_file, fingerprint)
+    else:
+        logger.info("Using terminology index %s", index_file)
+    return TerminologyIndex(index_file)
+
+
+class TerminologyIndex:
+    """
+    Read-only, memory-mapped view of an index file.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        with open(index_file, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.fingerprint, n_strings, pool_size, n_systems, n_codes, n_vs, n_members = \
+            _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{index_file} is not a version {FORMAT_VERSION} terminology index")
+        self._n_strings = n_strings
+        self._offsets = _HEADER.size
+        self._pool = self._offsets + (n_strings + 1) * 4
+        self._systems = self._pool + pool_size
+        self._codes = self._systems + n_systems * _PAIR.size
+        self._valuesets = self._codes + n_codes * _TRIPLE.size
+        self._members = self._valuesets + n_vs * _PAIR.size
+        self._counts = {'systems': n_systems, 'codes': n_codes, 'valuesets': n_vs, 'members': n_members}
+
+    def close(self):
+        self._mm.close()
+
+    def _string(self, i):
+        start, end = struct.unpack_from('<II', self._mm, self._offsets + i * 4)
+        return self._mm[self._pool + start:self._pool + end]
+
+    def string(self, i):
+        return None if i == NO_STRING else self._string(i).decode('utf-8')
+
+    def string_id(self, value):
+        if value is None:
+            return NO_STRING
+        target = value.encode('utf-8')
+        lo, hi = 0, self._n_strings
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._n_strings and self._string(lo) == target else None
+
+    def _find(self, base, count, record, key):
+        # Binary search a sorted record table on its leading fields; returns the record or None
+        lo, hi = 0, count
+        width = len(key)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if record.unpack_from(self._mm, base + mid * record.size)[:width] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < count:
+            row = record.unpack_from(self._mm, base + lo * record.size)
+            if row[:width] == key:
+                return row
+        return None
+
+    def code_status(self, system, code):
+        """
+        Look a code up in the IG package CodeSystems.
+
+        Returns:
+            tuple or None: (is_valid, display), or None when the index can't decide
+            (CodeSystem not in the packages, or the code is absent from a fragment).
+        """
+        system_id = self.string_id(system)
+        if system_id is None:
+            return None
+        system_row = self._find(self._systems, self._counts['systems'], _PAIR, (system_id,))
+        if system_row is None:
+            return None
+        code_id = self.string_id(code)
+        if code_id is not None:
+            row = self._find(self._codes, self._counts['codes'], _TRIPLE, (system_id, code_id))
+            if row is not None:
+                return True, self.string(row[2])
+        return (False, None) if system_row[1] & COMPLETE else None
+
+    def valueset_contains(self, url, system, code):
+        """
+        Returns:
+            bool or None: Membership of an enumerated IG package ValueSet, None if not known locally.
+        """
+        vs_id = self.string_id(url.split('|')[0])
+        if vs_id is None:
+            return None
+        vs_row = self._find(self._valuesets, self._counts['valuesets'], _PAIR, (vs_id,))
+        if vs_row is None or not vs_row[1] & COMPLETE:
+            return None
+        system_id, code_id = self.string_id(system), self.string_id(code)
+        if system_id is None or code_id is None:
+            return False
+        return self._find(self._members, self._counts['members'], _TRIPLE, (vs_id, system_id, code_id)) is not None
+
+    def stats(self):
+        return dict(self._counts)
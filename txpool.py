@@ -0,0 +1,333 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+##
+## Terminology server pool
+##
+## config.json "init" lists one or more servers:
+##   { "endpoint": "https://tx1/fhir", "weight": 2, "systems": ["http://snomed.info/sct", "http://example.*"] }
+## "weight" (default 1) sets each server's share of the traffic, "systems" optionally routes
+## those code systems (exact, or prefix with a trailing *) to that server. Requests are
+## spread over healthy servers by smooth weighted round robin and fail over to the next
+## server on connection errors, timeouts and 5xx responses. A server that fails
+## FAILURE_THRESHOLD times in a row is rested for COOLDOWN_SECONDS.
+##
+## The pool also keeps an LRU cache of successful (200) validation results, parsed, so
+## each distinct code is only sent once however many files, re-runs (watch mode) or
+## requests (the service) use it. Errors such as 429 or 404 are never cached, so the
+## next use of the code asks again.
+##
+
+FAILURE_THRESHOLD = 3
+COOLDOWN_SECONDS = 30
+USER_AGENT = 'FHIR-Terminology-Validator-Client/1.0'
+CACHE_SIZE = 100000   # validation results kept by the pool's LRU cache
+
+
+class Endpoint:
+    def __init__(self, url, weight=1, systems=None):
+        self.url = url.rstrip('/')
+        self.weight = max(1, int(weight))
+        self.systems = list(systems or [])
+        self._local = threading.local()   # one requests.Session per thread
+        self.healthy = True
+        self.capability_status = None
+        self.current_weight = 0
+        self.consecutive_failures = 0
+        self.retry_at = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.total_latency = 0.0
+
+    @property
+    def session(self):
+        """
+        This thread's keep-alive session to the server; requests.Session is not thread-safe.
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+
+            session = self._local.session = requests.Session()
+            session.headers.update({'Accept': 'application/fhir+json', 'User-Agent': USER_AGENT})
+        return session
+
+    def routes(self, system):
+        for pattern in self.systems:
+            if pattern.endswith('*') and system and system.startswith(pattern[:-1]):
+                return True
+            if pattern == system:
+                return True
+        return False
+
+    def available(self, now):
+        return self.healthy or now >= self.retry_at
+
+    def stats(self):
+        return {
+            'endpoint': self.url,
+            'weight': self.weight,
+            'healthy': self.healthy,
+            'requests': self.requests,
+            'failures': self.failures,
+            'mean_latency_ms': round(1000 * self.total_latency / self.requests, 1) if self.requests else None
+        }
+
+
+class EndpointPool:
+    """
+    A set of terminology servers with weighted balancing, health tracking and failover.
+    """
+
+    def __init__(self, endpoints, cache=True, cache_size=CACHE_SIZE):
+        if not endpoints:
+            raise ValueError("At least one terminology server endpoint is required")
+        self.endpoints = endpoints
+        self._lock = threading.Lock()
+        self.cache = OrderedDict() if cache else None   # key -> (parsed result, server url), least recent first
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @classmethod
+    def from_config(cls, init_conf, cache=True):
+        """
+        Build a pool from the config.json "init" list (or a single endpoint URL).
+        """
+        if isinstance(init_conf, str):
+            return cls([Endpoint(init_conf)], cache)
+        return cls([Endpoint(conf['endpoint'], conf.get('weight', 1), conf.get('systems')) for conf in init_conf], cache)
+
+    def __str__(self):
+        return ', '.join(f"{ep.url} (weight {ep.weight})" for ep in self.endpoints)
+
+    def primary(self):
+        """
+        The first healthy endpoint, for clients that talk to a single server.
+        """
+        return next((ep for ep in self.endpoints if ep.healthy), self.endpoints[0])
+
+    def check_capabilities(self, capability_test):
+        """
+        Capability-check every endpoint in parallel, marking the ones that fail unhealthy.
+
+        Args:
+            capability_test (callable): endpoint url -> http status, e.g. tester.run_capability_test
+
+        Returns:
+            list: The healthy endpoints.
+        """
+        def check(ep):
+            try:
+                ep.capability_status = capability_test(ep.url)
+            except Exception as e:
+                logger.error("Capability test failed for %s: %s", ep.url, e)
+                ep.capability_status = None
+            ep.healthy = ep.capability_status == 200
+            if not ep.healthy:
+                ep.retry_at = float('inf')
+                logger.error("Capability test failed for %s with status: %s", ep.url, ep.capability_status)
+            return ep
+
+        with ThreadPoolExecutor(max_workers=len(self.endpoints)) as pool:
+            list(pool.map(check, self.endpoints))
+        return [ep for ep in self.endpoints if ep.healthy]
+
+    def choose(self, system=None, tried=()):
+        """
+        Pick the endpoint for the next request, or None if every candidate has been tried.
+        Endpoints routed for the code system are preferred; otherwise smooth weighted
+        round robin over the available endpoints.
+        """
+        with self._lock:
+            now = time.monotonic()
+            untried = [ep for ep in self.endpoints if ep not in tried]
+            candidates = [ep for ep in untried if ep.available(now)]
+            routed = [ep for ep in candidates if ep.routes(system)]
+            if routed:
+                candidates = routed
+            elif not candidates:
+                # Everything is resting: try whichever comes back soonest rather than give up
+                resting = [ep for ep in untried if ep.retry_at != float('inf')]
+                return min(resting, key=lambda ep: ep.retry_at) if resting else None
+            total = sum(ep.weight for ep in candidates)
+            for ep in candidates:
+                ep.current_weight += ep.weight
+            best = max(candidates, key=lambda ep: ep.current_weight)
+            best.current_weight -= total
+            return best
+
+    def has_fallback(self, tried):
+        """
+        Whether choose() would still find an endpoint not in `tried`.
+        """
+        return any(ep not in tried and ep.retry_at != float('inf') for ep in self.endpoints)
+
+    def report_success(self, ep, latency):
+        with self._lock:
+            ep.requests += 1
+            ep.total_latency += latency
+            ep.consecutive_failures = 0
+            if not ep.healthy:
+                logger.info("Terminology server %s is answering again", ep.url)
+            ep.healthy = True
+
+    def report_failure(self, ep, latency, error):
+        with self._lock:
+            ep.requests += 1
+            ep.failures += 1
+            ep.total_latency += latency
+            ep.consecutive_failures += 1
+            if ep.consecutive_failures >= FAILURE_THRESHOLD and ep.healthy:
+                ep.healthy = False
+                ep.retry_at = time.monotonic() + COOLDOWN_SECONDS
+                logger.warning("Marking terminology server %s unhealthy for %ss: %s", ep.url, COOLDOWN_SECONDS, error)
+
+    def stats(self):
+        return [ep.stats() for ep in self.endpoints]
+
+    def cache_stats(self):
+        return {'entries': len(self.cache or ()), 'hits': self.cache_hits, 'misses': self.cache_misses}
+
+    def cached(self, key):
+        """
+        The (parsed result, server url) stored for key, or None.
+        """
+        if self.cache is None:
+            return None
+        with self._lock:
+            hit = self.cache.get(key)
+            if hit is None:
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+                self.cache.move_to_end(key)
+            return hit
+
+    def store(self, key, result, server):
+        """
+        Cache a parsed result from a successful (200) response, evicting the least recently used.
+        """
+        if self.cache is None:
+            return
+        with self._lock:
+            self.cache[key] = (result, server)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+
+class Counters:
+    """
+    Named counts that can be added to from several threads; reads like a dict.
+    """
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(names, 0)
+
+    def add(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def __getitem__(self, name):
+        return self._counts[name]
+
+    def __repr__(self):
+        return repr(self._counts)
+
+
+class LRUCache:
+    """
+    A thread-safe mapping keeping only the `maxsize` most recently used entries.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+def tx_get(endpoint, path, params, system=None, timeout=15):
+    """
+    GET a terminology operation from a single server url or an EndpointPool.
+    With a pool, connection errors, timeouts and 5xx responses fail over to the next
+    server; the final response (or exception) is returned as for requests.get.
+    Responses are not cached here; callers cache parsed results with pool.cached/store.
+
+    Returns:
+        tuple: (response, server url)
+    """
+    return _tx_request(endpoint, 'GET', path, system, timeout, params=params)
+
+
+def tx_post(endpoint, path, resource, system=None, timeout=60):
+    """
+    POST a FHIR resource (e.g. a batch Bundle to path '') with the same balancing and
+    failover as tx_get.
+
+    Returns:
+        tuple: (response, server url)
+    """
+    return _tx_request(endpoint, 'POST', path, system, timeout, json=resource,
+                       headers={'Content-Type': 'application/fhir+json'})
+
+
+def _tx_request(endpoint, method, path, system, timeout, **kwargs):
+    import requests
+
+    if not isinstance(endpoint, EndpointPool):
+        base = endpoint if endpoint.endswith('/') else endpoint + '/'
+        headers = {'Accept': 'application/fhir+json', 'User-Agent': USER_AGENT, **kwargs.pop('headers', {})}
+        response = requests.request(method, f'{base}{path}', headers=headers, timeout=timeout, **kwargs)
+        return response, endpoint.rstrip('/')
+
+    tried = []
+    while True:
+        ep = endpoint.choose(system, tried)
+        if ep is None:
+            raise requests.exceptions.ConnectionError("No healthy terminology server available")
+        tried.append(ep)
+        start = time.perf_counter()
+        try:
+            response = ep.session.request(method, f'{ep.url}/{path}', timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            endpoint.report_failure(ep, time.perf_counter() - start, e)
+            if not endpoint.has_fallback(tried):
+                raise
+            logger.warning("Failing over from %s: %s", ep.url, e)
+            continue
+        if response.status_code >= 500:
+            endpoint.report_failure(ep, time.perf_counter() - start, f"HTTP {response.status_code}")
+            if endpoint.has_fallback(tried):
+                logger.warning("Failing over from %s: HTTP %s", ep.url, response.status_code)
+                continue
+        else:
+            endpoint.report_success(ep, time.perf_counter() - start)
+        return response, ep.url
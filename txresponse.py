@@ -0,0 +1,54 @@
+##
+## Parsing of terminology server responses, shared by the code checks (tester.py),
+## the ValueSet binding checks (bindings.py) and the display checks (display.py)
+##
+
+TRANSIENT_STATUSES = (408, 429)   # 4xx statuses worth asking again later
+
+
+def is_rejection(error):
+    """
+    Whether a failed request was definitely refused by the server (a 4xx other than
+    408 or 429), as opposed to a timeout, rate limit or server error that may pass.
+
+    Args:
+        error (Exception): The exception raised for the request, e.g. by raise_for_status.
+    """
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return status is not None and 400 <= status < 500 and status not in TRANSIENT_STATUSES
+
+
+def parse_validate_code_response(response_json):
+    """
+    Parses the JSON response (FHIR Parameters) from a $validate-code operation.
+
+    Args:
+        response_json (dict): The parsed JSON response.
+
+    Returns:
+        tuple: (is_valid, display, message)
+               is_valid (bool or None): True if valid, False if invalid, None if result not found.
+               display (str or None): The canonical display from the server, or None.
+               message (str or None): The message from the server, or None.
+    """
+    is_valid = None
+    display = None
+    message = None
+
+    if not isinstance(response_json, dict) or response_json.get('resourceType') != 'Parameters':
+        return None, None, "Invalid response format: Not a Parameters resource."
+
+    parameters = response_json.get('parameter', [])
+
+    for param in parameters:
+        if isinstance(param, dict):
+            name = param.get('name')
+            if name == 'result':
+                is_valid = param.get('valueBoolean') # Should be True or False
+            elif name == 'display':
+                display = param.get('valueString')
+            elif name == 'message':
+                message = param.get('valueString')
+
+    return is_valid, display, message
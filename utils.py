@@ -2,6 +2,7 @@ import os
 import sys
 import json
 import shutil
+from functools import lru_cache
 
 ##
 ## check_path():
@@ -29,10 +30,13 @@ def get_config(filepath,key=None):
 ##
 ## split node path: Split up the node_modules path to the IG name and file
 ##
+@lru_cache(maxsize=4096)
 def split_node_path(filepath):
     """
     Splits the given file path into '<module>: <filename>', where <module> is the part of the path
     immediately after 'node_modules' and <filename> is the file name.
+    Cached, so it is computed once per file rather than once per coding, and the
+    result is interned so every row for the file shares the same string.
     """
     # Extract the filename
     filename = os.path.basename(filepath)
@@ -50,4 +54,4 @@ def split_node_path(filepath):
         module_part = "unknown_module"
     
     # Format the result
-    return f'{filename}'
\ No newline at end of file
+    return sys.intern(f'{filename}')
\ No newline at end of file
@@ -0,0 +1,176 @@
+import os
+import time
+import queue
+import logging
+from tester import get_json_files, write_html_report
+from results import results_to_dataframe
+from utils import split_node_path
+
+logger = logging.getLogger(__name__)
+
+##
+## Watch mode: validate everything once, then re-validate only the files that change,
+## reusing the same TerminologyChecks (and so the same warm caches) and rewriting the
+## HTML report after each change. Exclusion rule hits are tracked per file, so a
+## re-checked or deleted file's old hits are taken off and the report's rule table
+## always matches its rows. Uses watchdog (inotify and friends) when it is
+## installed, otherwise polls file modification times.
+##
+
+POLL_INTERVAL = 0.5
+
+
+def _snapshot(jdir):
+    state = {}
+    for path in get_json_files(jdir):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        state[path] = (st.st_mtime_ns, st.st_size)
+    return state
+
+
+def poll_changes(jdir, interval=POLL_INTERVAL):
+    """
+    Yield (changed, deleted) sets of json file paths, found by comparing mtimes and sizes.
+    The baseline is taken now, so changes made while the first pass runs are not missed.
+    """
+    previous = _snapshot(jdir)
+
+    def changes():
+        nonlocal previous
+        while True:
+            time.sleep(interval)
+            current = _snapshot(jdir)
+            changed = {path for path, sig in current.items() if previous.get(path) != sig}
+            deleted = set(previous) - set(current)
+            previous = current
+            if changed or deleted:
+                yield changed, deleted
+
+    return changes()
+
+
+def notify_changes(jdir, interval=POLL_INTERVAL):
+    """
+    Yield (changed, deleted) sets of json file paths from filesystem events (requires watchdog).
+    Events are gathered for a short settle time so an editor's save is handled once.
+    """
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+
+    events = queue.Queue()
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory:
+                return
+            for path in (event.src_path, getattr(event, 'dest_path', None)):
+                if path and path.endswith('.json'):
+                    events.put(os.path.abspath(path))
+
+    # Start watching now, so changes made while the first pass runs are not missed
+    observer = Observer()
+    observer.schedule(Handler(), jdir, recursive=True)
+    observer.start()
+
+    def changes():
+        try:
+            while True:
+                touched = {events.get()}
+                deadline = time.monotonic() + min(interval, 0.1)
+                while (remaining := deadline - time.monotonic()) > 0:
+                    try:
+                        touched.add(events.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                yield {p for p in touched if os.path.isfile(p)}, {p for p in touched if not os.path.exists(p)}
+        finally:
+            observer.stop()
+            observer.join()
+
+    return changes()
+
+
+def watch_changes(jdir, interval=POLL_INTERVAL, use_notify=True):
+    if use_notify:
+        try:
+            import watchdog  # noqa: F401
+            logger.info("Watching %s for changes with watchdog", jdir)
+            return notify_changes(jdir, interval)
+        except ImportError:
+            logger.info("watchdog is not installed, polling for changes instead")
+    return poll_changes(jdir, interval)
+
+
+def _summary(rows):
+    fails = sum(row.result == 'FAIL' for row in rows)
+    errors = sum(row.result == 'ERROR' for row in rows)
+    return f"{len(rows)} results, {fails} FAIL, {errors} ERROR"
+
+
+def watch_terminology_check(checks, jdir, outdir, interval=POLL_INTERVAL, use_notify=True, max_updates=None):
+    """
+    Validate jdir, then keep re-validating changed files and updating the HTML report until interrupted.
+
+    Args:
+        checks (TerminologyChecks): Shared validation setup, kept warm between changes.
+        jdir (str): Directory containing FHIR JSON example instances.
+        outdir (str): Directory for TestDataValidationReport.html.
+        interval (float): Poll interval / event settle time in seconds.
+        use_notify (bool): Use filesystem events when watchdog is installed.
+        max_updates (int): Stop after this many updates (for tests); None runs until interrupted.
+    """
+    html_file = os.path.join(outdir, 'TestDataValidationReport.html')
+    results = {}     # file path -> ResultRows, in report order
+    file_hits = {}   # file path -> exclusion rule hits counted for its rows
+    rules = checks.cs_excluded
+
+    def write_report():
+        rows = [row for file_rows in results.values() for row in file_rows]
+        write_html_report(results_to_dataframe(rows), checks.rules_dataframe(), html_file)
+        return rows
+
+    start = time.perf_counter()
+    changes = watch_changes(jdir, interval, use_notify)
+    hits_before = rules.hit_counts()
+    for instance_file, file_rows in checks.check_files(get_json_files(jdir)):
+        hits_after = rules.hit_counts()
+        results[os.path.abspath(instance_file)] = file_rows
+        file_hits[os.path.abspath(instance_file)] = hits_after - hits_before
+        hits_before = hits_after
+    rows = write_report()
+    print(f"Validated {len(results)} files in {time.perf_counter() - start:.1f}s: {_summary(rows)}")
+    print(f"Watching {jdir} for changes, report at {html_file} (Ctrl-C to stop)")
+
+    updates = 0
+    try:
+        for changed, deleted in changes:
+            start = time.perf_counter()
+            for instance_file in sorted(deleted):
+                results.pop(os.path.abspath(instance_file), None)
+                rules.remove_hits(file_hits.pop(os.path.abspath(instance_file), {}))
+                print(f"  removed {split_node_path(instance_file)}")
+            for instance_file in sorted(changed):
+                rules.remove_hits(file_hits.pop(os.path.abspath(instance_file), {}))
+                hits_before = rules.hit_counts()
+                file_rows = checks.check_file(instance_file)
+                results[os.path.abspath(instance_file)] = file_rows
+                file_hits[os.path.abspath(instance_file)] = rules.hit_counts() - hits_before
+                print(f"  {split_node_path(instance_file)}: {_summary(file_rows)}")
+                for row in file_rows:
+                    if row.result in ('FAIL', 'ERROR'):
+                        print(f"    {row.result} {row.path} {row.system}|{row.code}: {row.reason}")
+            write_report()
+            elapsed = time.perf_counter() - start
+            logger.info("Watch update: %s changed, %s removed in %.0f ms", len(changed), len(deleted), elapsed * 1000)
+            print(f"  report updated in {elapsed * 1000:.0f} ms")
+            updates += 1
+            if max_updates is not None and updates >= max_updates:
+                break
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        changes.close()
+        checks.log_stats()